@@ -11,9 +11,6 @@ from time import sleep
 
 from scipy.sparse.csgraph import connected_components 
 
-import tensorflow as tf
-from tensorflow.keras import backend as K
-
 from dipy.segment.clustering import QuickBundles
 from dipy.segment.bundles import RecoBundles
 from dipy.segment.metric import (AveragePointwiseEuclideanMetric,
@@ -21,21 +18,20 @@ from dipy.segment.metric import (AveragePointwiseEuclideanMetric,
 from dipy.tracking._utils import _mapping_to_voxel, _to_voxel_coordinates
 from dipy.segment.clustering import Cluster, ClusterMap
 
-from models.model_classes import FisherVonMises
-from models import load_model
-
 from resample_trk import maybe_add_tangent 
 from utils.config import load
-from utils.training import setup_env, maybe_get_a_gpu
-from utils.prediction import get_blocksize
-from utils._dispatch import get_gpus
+from utils.env import setup_env, maybe_get_a_gpu, clear_session
+from utils.prediction import (Neighborhood, FeatureTable, get_blocksize,
+    to_numpy)
+from utils.numpy_model import load_numpy_model
+from utils.cache import cache_key, cache_dir_for, load_volume
 
 from configs import save
 
 @setup_env
 def agreement(model_path, dwi_path_1, trk_path_1, dwi_path_2, trk_path_2,
     wm_path, fixel_cnt_path, cluster_thresh, centroid_size, fixel_thresh,
-    bundle_min_cnt, gpu_queue=None):
+    bundle_min_cnt, gpu_queue=None, brick_size=None, engine="keras"):
 
     try:
         gpu_idx = maybe_get_a_gpu() if gpu_queue is None else gpu_queue.get()
@@ -44,25 +40,22 @@ def agreement(model_path, dwi_path_1, trk_path_1, dwi_path_2, trk_path_2,
         print(str(e))
 
     temperature = np.round(float(re.findall("T=(.*)\.h5", model_path)[0]), 6)
-    model = load_model(model_path)
+    if engine == "numpy":
+        model = load_numpy_model(model_path)
+    else:
+        from models import load_model
+        model = load_model(model_path)
 
     print("Load data ...")
 
-    dwi_img_1 = nib.load(dwi_path_1)
-    dwi_img_1 = nib.funcs.as_closest_canonical(dwi_img_1)
-    affine_1 = dwi_img_1.affine
-    dwi_1 = dwi_img_1.get_data()
+    dwi_1, affine_1 = load_volume(dwi_path_1, canonical=True)
 
-    dwi_img_2 = nib.load(dwi_path_2)
-    dwi_img_2 = nib.funcs.as_closest_canonical(dwi_img_2)
-    affine_2 = dwi_img_2.affine
-    dwi_2 = dwi_img_2.get_data()
+    dwi_2, affine_2 = load_volume(dwi_path_2, canonical=True)
 
-    wm_img = nib.load(wm_path)
-    wm_data = wm_img.get_data()
+    wm_data, _ = load_volume(wm_path)
     n_wm = (wm_data > 0).sum()
 
-    fixel_cnt = nib.load(fixel_cnt_path).get_data()[:,:,:,0]
+    fixel_cnt = load_volume(fixel_cnt_path, dtype=None)[0][:,:,:,0]
     fixel_cnt = fixel_cnt[wm_data>0]
 
     k_fixels = np.unique(fixel_cnt)
@@ -197,30 +190,23 @@ def agreement(model_path, dwi_path_1, trk_path_1, dwi_path_2, trk_path_2,
 
     block_size = get_blocksize(model, dwi_1.shape[-1])
 
-    d_1 = np.zeros([
-        n_fixels_sum,
-        block_size,  block_size, block_size,
-        dwi_1.shape[-1]
-    ])
-    d_2 = np.zeros([
-        n_fixels_sum,
-        block_size,  block_size, block_size,
-        dwi_1.shape[-1]
-    ])
-    i,j,k = fixel_ijk.T
-    for idx in range(block_size**3):
-        ii,jj,kk = np.unravel_index(idx, (block_size, block_size, block_size))
-        d_1[:, ii, jj, kk, :] = dwi_1[i+ii-1, j+jj-1, k+kk-1, :]
-        d_2[:, ii, jj, kk, :] = dwi_2[i+ii-1, j+jj-1, k+kk-1, :]
-
-    d_1 = d_1.reshape(-1, dwi_1.shape[-1] * block_size**3)
-    d_2 = d_2.reshape(-1, dwi_2.shape[-1] * block_size**3)
-
-    dnorm_1 = np.linalg.norm(d_1, axis=1, keepdims=True) + 10**-2
-    dnorm_2 = np.linalg.norm(d_2, axis=1, keepdims=True) + 10**-2
-
-    d_1 /= dnorm_1
-    d_2 /= dnorm_2
+    # Features of all WM voxels are cached, they are shared by all temperatures
+    cache_dir_1 = cache_dir_for(dwi_path_1, "feature_tables")
+    d_1, dnorm_1 = FeatureTable(
+        Neighborhood(dwi_1, block_size, brick=brick_size,
+                     cache_dir=cache_dir_1, key=cache_key(dwi_path_1)),
+        mask=wm_data > 0,
+        cache_dir=cache_dir_1,
+        key=cache_key(dwi_path_1)
+    ).features(fixel_ijk)
+    cache_dir_2 = cache_dir_for(dwi_path_2, "feature_tables")
+    d_2, dnorm_2 = FeatureTable(
+        Neighborhood(dwi_2, block_size, brick=brick_size,
+                     cache_dir=cache_dir_2, key=cache_key(dwi_path_2)),
+        mask=wm_data > 0,
+        cache_dir=cache_dir_2,
+        key=cache_key(dwi_path_2)
+    ).features(fixel_ijk)
 
     model_inputs_1 = np.hstack([fixel_directions_1, d_1, dnorm_1])
     model_inputs_2 = np.hstack([fixel_directions_2, d_2, dnorm_2])
@@ -300,7 +286,7 @@ def agreement(model_path, dwi_path_1, trk_path_1, dwi_path_2, trk_path_2,
         fixel_agreements=fixel_agreements,
     )
 
-    K.clear_session()
+    clear_session()
     if gpu_queue is not None:
         gpu_queue.put(gpu_idx)
 
@@ -345,8 +331,8 @@ def agreement_for(model, inputs1, inputs2, fixel_cnts_1, fixel_cnts_2):
         kappa1[c * chunk : (c + 1) * chunk] = k1
         kappa2[c * chunk : (c + 1) * chunk] = k2
 
-        mu1[c * chunk : (c + 1) * chunk] = fvm_pred_1.mean_direction.numpy()
-        mu2[c * chunk : (c + 1) * chunk] = fvm_pred_2.mean_direction.numpy()
+        mu1[c * chunk : (c + 1) * chunk] = to_numpy(fvm_pred_1.mean_direction)
+        mu2[c * chunk : (c + 1) * chunk] = to_numpy(fvm_pred_2.mean_direction)
         
     np.maximum(log_fvm, 0, out=log_fvm)
 
@@ -356,23 +342,15 @@ def agreement_for(model, inputs1, inputs2, fixel_cnts_1, fixel_cnts_2):
 
 
 def fvm_log_agreement(fvm1, fvm2, cnts1, cnts2):
-    fvm1._concentration *= cnts1
-    fvm2._concentration *= cnts2
-
-    fvm12 = FisherVonMises(
-        mean_direction=fvm1.mean_direction, # just a dummy, not used
-        concentration=tf.norm(
-            fvm1.mean_direction * fvm1.concentration[:, tf.newaxis] +
-            fvm2.mean_direction * fvm2.concentration[:, tf.newaxis],
-            axis=1)
-    )
+    mu1 = to_numpy(fvm1.mean_direction)
+    mu2 = to_numpy(fvm2.mean_direction)
+    kappa1 = to_numpy(fvm1.concentration) * cnts1
+    kappa2 = to_numpy(fvm2.concentration) * cnts2
 
-    return (
-        np.log(4 * np.pi)
-        + fvm12._log_normalization()
-        - fvm1._log_normalization()
-        - fvm2._log_normalization()
-    )
+    kappa12 = np.linalg.norm(
+        mu1 * kappa1[:, np.newaxis] + mu2 * kappa2[:, np.newaxis], axis=1)
+
+    return np.log(4 * np.pi) + logZ(kappa12) - logZ(kappa1) - logZ(kappa2)
 
 
 def safe_sign(x):
@@ -479,12 +457,20 @@ if __name__ == '__main__':
     parser.add_argument("--fthresh", help="Fixel threshold (as fraction of pi)",
         type=float, default=6., dest="fixel_thresh")
 
+    parser.add_argument("--brick_size", help="Store the DWI in bricks of this "
+        "many voxels per side", type=int)
+
+    parser.add_argument("--engine", help="keras, or numpy to run the .npz "
+        "export of the model without TensorFlow", type=str, default="keras")
+
     args = parser.parse_args()
 
     if args.config_path is not None:
 
         config = load(args.config_path)
 
+        from utils._dispatch import get_gpus
+
         gpu_queue = SimpleQueue()
         for idx in get_gpus()[:4]:
             gpu_queue.put(str(idx))
@@ -510,7 +496,9 @@ if __name__ == '__main__':
                               config["agreement"]["centroid_size"],
                               config["agreement"]["fixel_thresh"],
                               config["agreement"]["bundle_min_cnt"],
-                              gpu_queue)
+                              gpu_queue,
+                              config["agreement"].get("brick_size"),
+                              config["agreement"].get("engine", "keras"))
                     )
                     procs.append(p)
                     p.start()
@@ -535,5 +523,7 @@ if __name__ == '__main__':
             args.cluster_thresh,
             args.fixel_thresh,
             args.bundle_min_cnt,
-            args.centroid_size
+            args.centroid_size,
+            brick_size=args.brick_size,
+            engine=args.engine
         )
\ No newline at end of file
@@ -1,6 +1,5 @@
 import os
 
-from models import MODELS
 from utils.config import *
 from utils.filelock import filelock
 
@@ -19,7 +18,9 @@ def compile_from(config_path, args, more_args):
 
 
 def check(config):
-    
+
+    from models import MODELS
+
     assert isinstance(config, dict)
 
     # ==========================================================================
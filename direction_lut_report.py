@@ -0,0 +1,68 @@
+import argparse
+
+import numpy as np
+
+from quantize_model import sample_inputs, mean_direction
+from utils.numpy_model import load_numpy_model
+from utils.prediction import DirectionGrid
+
+
+def angle(a, b):
+    """Angle in degrees between the rows of a and b."""
+    a, b = a.astype("float64"), b.astype("float64")
+    return np.degrees(np.arctan2(np.linalg.norm(np.cross(a, b), axis=1),
+                                 np.sum(a * b, axis=1)))
+
+
+def report(model, inputs, grid_sizes, chunk=2**12):
+    """Error of direction_lut: the incoming direction is replaced by the
+    center of its grid cell. Reports the angle between the two, and between
+    the mean directions the model predicts for them."""
+
+    def predict(x):
+        return np.vstack([mean_direction(model, x[i:i + chunk])
+                          for i in range(0, len(x), chunk)])
+
+    mu = predict(inputs)
+
+    print("{:>5s} {:>7s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}".format(
+        "n", "cells", "vin mean", "vin max", "mu mean", "mu p95", "mu max"))
+    for n in grid_sizes:
+        grid = DirectionGrid(n)
+        vin = inputs[:, :3]
+        centers = grid.centers[grid.index(vin)]
+
+        quantized = inputs.copy()
+        quantized[:, :3] = centers
+        vin_error = angle(vin, centers)
+        mu_error = angle(mu, predict(quantized))
+
+        print("{:5d} {:7d} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:9.3f}".format(
+            n, grid.n_bins, vin_error.mean(), vin_error.max(),
+            mu_error.mean(), np.percentile(mu_error, 95), mu_error.max()))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Angular error (degrees) of the approximate tracking mode "
+        "(direction_lut) for several direction grid sizes.")
+
+    parser.add_argument("model_path", help="Path to .h5 file", type=str)
+
+    parser.add_argument("dwi_path", help="Path to .nii file, whose voxels are "
+        "sampled for the report", type=str)
+
+    parser.add_argument("--grid_sizes", nargs="+", type=int,
+        default=[16, 32, 64, 128])
+
+    parser.add_argument("--n_samples", type=int, default=2**15)
+
+    args = parser.parse_args()
+
+    model = load_numpy_model(args.model_path)
+    if "mu" in [node["name"] for node in model.nodes]:
+        model = model.select("mu")
+
+    report(model, sample_inputs(model, args.dwi_path, args.n_samples),
+           args.grid_sizes)
@@ -0,0 +1,24 @@
+import argparse
+
+from models import load_model
+from utils.numpy_model import export, numpy_model_path
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Export a trained Dense tracker for the NumPy inference "
+        "engine (engine: numpy), which runs without TensorFlow.")
+
+    parser.add_argument("model_path", help="Path to .h5 file", type=str)
+
+    parser.add_argument("--out_path", help="Path to .npz file, by default "
+        "next to the model.", type=str, default=None)
+
+    args = parser.parse_args()
+
+    out_path = args.out_path or numpy_model_path(args.model_path)
+
+    export(load_model(args.model_path), out_path)
+
+    print("Saved {}".format(out_path))
@@ -12,6 +12,8 @@ import itertools
 
 from scipy.interpolate import RegularGridInterpolator
 
+from utils.cache import load_volume
+
 os.environ['PYTHONHASHSEED'] = '0'
 np.random.seed(42)
 random.seed(12345)
@@ -267,17 +269,12 @@ def generate_samples(dwi_path,
     assert trk_file.tractogram.data_per_point is not None
     assert "t" in trk_file.tractogram.data_per_point
     #===========================================================================
-    dwi_img = nib.load(dwi_path)
-    dwi_img = nib.funcs.as_closest_canonical(dwi_img)
-    dwi_aff = dwi_img.affine
+    dwi, dwi_aff = load_volume(dwi_path, canonical=True)
     dwi_affi = np.linalg.inv(dwi_aff)
     dwi_xyz2ijk = lambda r: dwi_affi.dot([r[0], r[1], r[2], 1])[:3]
-    dwi = dwi_img.get_data()
 
     fa_path = os.path.join(os.path.dirname(dwi_path), "tensor_FA.nii.gz")
-    fa_img = nib.load(fa_path)
-    fa_img = nib.funcs.as_closest_canonical(fa_img)
-    fa_data = fa_img.get_data()
+    fa_data, fa_aff = load_volume(fa_path, canonical=True)
 
     tracts = trk_file.tractogram # fiber coordinates in rasmm
     #===========================================================================
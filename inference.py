@@ -1,27 +1,34 @@
 import os
 import gc
 import argparse
+import shutil
 import datetime
+import tempfile
+import multiprocessing
 import yaml
 import git
 
 import nibabel as nib
 import numpy as np
 
-from tensorflow.keras.models import load_model
-from tensorflow.keras import backend as K
-
 from nibabel.streamlines.trk import TrkFile
-from nibabel.streamlines.array_sequence import ArraySequence
 from nibabel.streamlines.tractogram import Tractogram
 
 from time import time
-
-from models import MODELS
+from concurrent.futures import ThreadPoolExecutor
 
 from utils.config import load
-from utils.prediction import Prior, Terminator, get_blocksize
-from utils.training import setup_env, maybe_get_a_gpu
+from utils.prediction import (Prior, Terminator, VoxelGrid, Neighborhood,
+    FeatureTable, ProjectionTable, DirectionGrid, PredictionCache,
+    padded_volume, seeded_uniform, sample, sample_fvm, get_blocksize,
+    to_numpy, concentration, limit_turn, StepSize)
+from utils.cache import cache_key, cache_dir_for, load_volume
+from utils.env import (setup_env, maybe_get_a_gpu, clear_session,
+    set_blas_threads)
+from utils.numpy_model import load_numpy_model, NumpyFirstLayerSplit
+from utils.tracking import (TrajectoryBuffer, StreamlineBuffer, SeedQueue,
+    FiberStitcher, Checkpoint, StageTimer, pipeline, morton_order, revisited)
+from utils.trk import TrkStreamWriter
 from utils._score import score
 
 from resample_trk import add_tangent
@@ -29,189 +36,725 @@ from resample_trk import add_tangent
 import configs
 
 
-@setup_env
-def run_inference(config=None, gpu_queue=None, return_to=None):
+def load_tracker(config):
+    """Load the trained model at config['model_path'].
 
-    """"""
-    gpu_idx = -1
-    try:
-        gpu_idx = maybe_get_a_gpu() if gpu_queue is None else gpu_queue.get()
-        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_idx
-    except Exception as e:
-        print(str(e))
+    With config['engine'] == "numpy", its NumPy export is loaded instead,
+    which runs without TensorFlow (see utils.numpy_model).
 
-    print("Loading Models...") #################################################
+    Only the outputs in config['model_outputs'] are computed ("mu",
+    "mu_kappa" or "full", see models.surgery.inference_model). By default,
+    tracking with predict_fn: mean only evaluates the mean direction (and
+    kappa with step_mode: kappa).
 
-    train_config_path = os.path.join(
-        os.path.dirname(config['model_path']), "config.yml")
+    The numpy engine can also load int8 or float16 quantized weights, with
+    config['model_weights'] (see quantize_model.py for their accuracy).
 
-    model_name = load(train_config_path, "model_name")
+    Models with stateful RNN layers are returned as a
+    models.surgery.RecurrentStep, which takes the states of the fibers.
+    """
+    outputs = config.get("model_outputs", "auto")
+    weights = config.get("model_weights", "float32")
 
-    if hasattr(MODELS[model_name], "custom_objects"):
-        model = load_model(config['model_path'],
-                           custom_objects=MODELS[model_name].custom_objects,
-                           compile=False)
+    if config.get("engine", "keras") == "numpy":
+        model = load_numpy_model(config['model_path'], weights=weights)
+        names = [node["name"] for node in model.nodes]
+    elif weights != "float32":
+        raise ValueError("model_weights: {} requires engine: numpy".format(
+            weights))
     else:
-        model = load_model(config['model_path'], compile=False)
+        from models import load_model
+        model = load_model(config['model_path'])
+        names = [layer.name for layer in model.layers]
+
+    if outputs == "auto":
+        outputs = "full"
+        if config.get("predict_fn") == "mean" and "mu" in names:
+            outputs = "mu"
+            if config.get("step_mode") == "kappa" and "kappa" in names:
+                outputs = "mu_kappa"
+
+    if config.get("engine", "keras") == "numpy":
+        return model.select(outputs)
+
+    from models.surgery import inference_model, is_recurrent, RecurrentStep
+    model = inference_model(model, outputs)
+    if is_recurrent(model):
+        # RNN states are kept per fiber by track()
+        return RecurrentStep(model)
+    return model
+
+
+def make_gather(config, model, volume, grid, padded=False):
+    """Return the feature gather for the tracking loop, and the optional
+    first layer split with its projection table. Feature tables cover the
+    voxels inside the termination mask of grid, a VoxelGrid of volume."""
+
+    block_size = get_blocksize(model, volume.shape[-1])
+    cache_dir = (config.get("cache_dir") or
+                 cache_dir_for(config['dwi_path'], "feature_tables"))
+
+    gather = Neighborhood(volume, block_size, padded=padded,
+                          brick=config.get("brick_size"), cache_dir=cache_dir,
+                          key=cache_key(config['dwi_path']))
+
+    if config.get("feature_table", False) or config.get("split_first_layer",
+                                                        False):
+        print("Loading feature table...")
+        gather = FeatureTable(
+            gather,
+            mask=grid.alive.reshape(grid.shape),
+            cache_dir=cache_dir,
+            key=cache_key(config['dwi_path'])
+        )
+
+    split, projection = None, None
+    if config.get("split_first_layer", False):
+        print("Loading first layer projections...")
+        if config.get("engine", "keras") == "numpy":
+            split = NumpyFirstLayerSplit(model)
+        else:
+            from models.surgery import FirstLayerSplit
+            split = FirstLayerSplit(model)
+        projection = ProjectionTable(gather, split.project,
+            key=cache_key(config['model_path'], split.kernel_voxel))
 
+    return gather, split, projection
 
-    print("Loading DWI...") ####################################################
 
-    dwi_img = nib.load(config['dwi_path'])
-    dwi_img = nib.funcs.as_closest_canonical(dwi_img)
-    dwi_aff = dwi_img.affine
-    dwi_affi = np.linalg.inv(dwi_aff)
-    dwi = dwi_img.get_data()
+def track(config, model, gather, split, projection, grid, seeds, order=None,
+          write=None, checkpoint=None, stats=None):
+    """Track both directions of seeds[order], and return the finished fibers
+    as a StreamlineBuffer, whose ids are the seed indices.
 
-    def xyz2ijk(coords, snap=False):
-        ijk = (coords.T).copy()
-        dwi_affi.dot(ijk, out=ijk)
-        if snap:
-            return np.round(ijk, out=ijk).astype(int, copy=False).T
-        else:
-            return ijk.T
+    With config['samples_per_seed'] = K > 1, every seed is tracked K times,
+    and the fiber ids are seed * K + sample.
 
-    ############################################################################
+    If write is given, finished fibers are instead passed to
+    write(streamlines, ids) in the order of the ids, every
+    config['flush_every'] steps. Then, the state is also saved to
+    checkpoint, if given, and tracking continues from the state saved in it
+    by an earlier run.
 
-    terminator = Terminator(config['term_path'], config['thresh'])
+    grid is the VoxelGrid of the DWI, with the termination mask and prior.
+    Besides the mask, fibers end where they turn by more than
+    config['stop_angle'] degrees in one step, or return to a voxel they
+    left (with config['loop_slots'] > 0). Fibers longer than
+    config['max_length'] are dropped while tracking.
 
-    prior = Prior(config['prior_path'])
+    If stats is given, its "steps" and "evaluations" are increased by the
+    fiber steps and the rows evaluated by the model, which are fewer with
+    direction_lut or samples_per_seed.
+    """
 
     print("Initializing Fibers...") ############################################
 
-    seed_file = nib.streamlines.load(config['seed_path'])
-    xyz = seed_file.tractogram.streamlines.data
-    n_seeds = 2 * len(xyz)
-    xyz = np.vstack([xyz, xyz])  # Duplicate seeds for both directions
-    xyz = np.hstack([xyz, np.ones([n_seeds, 1])]) # add affine dimension
-    xyz = xyz.reshape(-1, 1, 4)  # (fiber, segment, coord)
-
-    fiber_idx = np.hstack([
-        np.arange(n_seeds//2, dtype="int32"),
-        np.arange(n_seeds//2,  dtype="int32")
-    ])
-    fibers = [[] for _ in range(n_seeds//2)]
+    # Positions, directions and model inputs, float64 only for validation
+    dtype = np.dtype(config.get("precision", "float32"))
+
+    if order is None:
+        order = np.arange(len(seeds))
+
+    # Samples of a seed are tracked side by side, see prepare()
+    samples_per_seed = config.get("samples_per_seed", 1)
+
+    if config.get("seed_order", "file") == "morton":
+        # Spatially close seeds are tracked together, for cache friendly
+        # gathers. Only blocks of max_active seeds are reordered, such that
+        # fibers can still be written in seed order without holding them all
+        block = (config.get("max_active") or len(order)) // samples_per_seed
+        block = max(block, 1)
+        ijk, _ = grid.locate(seeds[order])
+        order = np.concatenate([
+            order[b:b + block][morton_order(ijk[b:b + block])]
+            for b in range(0, len(order), block)])
+    reorder_every = config.get("reorder_every", 0)
+
+    order = (samples_per_seed * order[:, np.newaxis]
+             + np.arange(samples_per_seed)).ravel()
+
+    # Terminated fibers are replaced by new seeds, up to max_active fibers
+    queue = SeedQueue(samples_per_seed * len(seeds), order=order)
+    n_seeds = len(queue)  # Each seed is tracked in both directions
+    max_active = config.get("max_active") or n_seeds
+
+    trajectories = TrajectoryBuffer(np.zeros([0, 3]),
+                                    capacity=config.get("capacity", 64),
+                                    dtype=dtype)
+    fiber_idx = np.zeros(0, dtype="int32")
+    fiber_flip = np.zeros(0, dtype=bool)
+    vout = np.zeros([0, 3], dtype=dtype)
+    # DWI voxel of the latest point, located when the point is added
+    fiber_ijk = np.zeros([0, 3], dtype=int)
+
+    # Recurrent models carry a state per fiber, see RecurrentStep
+    recurrent = hasattr(model, "zero_states")
+    rnn_states = model.zero_states(0) if recurrent else []
+
+    # Geometric termination, see revisited() for the voxel hash
+    stop_angle = config.get("stop_angle", 0)
+    max_length = config.get("max_length")
+    fiber_length = np.zeros(samples_per_seed * len(seeds))
+    loop_slots = config.get("loop_slots", 0)
+    visited = np.zeros([0, loop_slots], dtype="int64")
+    voxel = np.zeros(0, dtype="int64")
+
+    # Finished halves are stitched into fibers once both ends terminated
+    stitcher = FiberStitcher(samples_per_seed * len(seeds), dtype=dtype)
+    n_flushed = 0
+
+    write_order = np.sort(order)
+
+    def flush():
+        # Longest run of seeds in seed order that are done
+        done = stitcher.done[write_order[n_flushed:]]
+        n_done = len(done) if done.all() else np.argmin(done)
+        streamlines, ids = stitcher.pop(
+            write_order[n_flushed:n_flushed + n_done])
+        if len(streamlines) > 0:
+            write(streamlines, ids)
+        return n_flushed + n_done
+
+    # Adaptive steps are longer where the model is confident
+    max_angle = config.get("max_step_angle", 0)
+    steps = StepSize(config.get("step_mode", "fixed"), config['step_size'],
+                     max_step_size=config.get("max_step_size"),
+                     max_kappa=config.get("max_kappa", 100),
+                     max_angle=max_angle)
+
+    # Predicted rows are [v, kappa], kappa only where it is needed
+    with_kappa = steps.mode == "kappa"
+
+    # Approximate mode, predictions are reused per voxel and direction cell
+    lut = None
+    if config.get("direction_lut", 0) > 0:
+        if recurrent:
+            raise ValueError("direction_lut does not apply to recurrent "
+                             "models, whose outputs depend on their state")
+        if config.get("predict_fn") == "sample":
+            with_kappa = True  # mu and kappa of the FvM are cached
+        lut = PredictionCache(grid.shape,
+                              DirectionGrid(config["direction_lut"]),
+                              3 + with_kappa,
+                              capacity=config.get("lut_capacity", 2**22))
+
+    # Feature gather and termination run on a thread pool, see pipeline()
+    n_groups = config.get("n_groups", 1)
+    executor = ThreadPoolExecutor(max_workers=2) if n_groups > 1 else None
+    timer = StageTimer()
 
     print("Start Iteration...") ################################################
 
-    block_size = get_blocksize(model, dwi.shape[-1])
-
-    for step in range(config['max_steps']):
+    step = 0
+    n_steps, n_evaluations, step_length = 0, 0, 0.0
+    state = checkpoint.load() if checkpoint is not None else None
+    if state is not None:
+        if not np.array_equal(state["order"], queue.order):
+            raise ValueError("{} was saved for other seeds".format(
+                checkpoint.path))
+        print("Resuming from step {} of {}".format(state["step"],
+                                                   checkpoint.path))
+        step = int(state["step"])
+        n_flushed = int(state["n_flushed"])
+        queue.n_taken = int(state["n_taken"])
+        trajectories = TrajectoryBuffer.from_flat(
+            state["points"], state["cursor"],
+            capacity=config.get("capacity", 64), dtype=dtype)
+        vout = state["vout"]
+        fiber_idx = state["fiber_idx"]
+        fiber_flip = state["fiber_flip"]
+        fiber_ijk, _ = grid.locate(trajectories.last())
+        fiber_length = state["fiber_length"]
+        visited = state["visited"]
+        voxel = state["voxel"]
+        rnn_states = [state["rnn_state_{}".format(i)]
+                      for i in range(len(rnn_states))]
+        stitcher.load_state(state)
+
+    while len(trajectories) > 0 or len(queue) > 0:
         t0 = time()
 
-        # Get coords of latest segement for each fiber
-        ijk = xyz2ijk(xyz[:,-1,:], snap=True)
-        n_ongoing = len(ijk)
-        i,j,k, _ = ijk.T
+        # Refill free slots, new fibers start along the prior
+        gidx, flip = queue.take(max_active - len(trajectories))
+        if len(gidx) > 0:
+            seed_idx = gidx // samples_per_seed
+            trajectories.add(seeds[seed_idx])
+            fiber_idx = np.hstack([fiber_idx, gidx])
+            fiber_flip = np.hstack([fiber_flip, flip])
+            new_ijk, new_index = grid.locate(seeds[seed_idx])
+            fiber_ijk = np.vstack([fiber_ijk, new_ijk])
+            # One prior lookup per seed and direction, shared by its samples
+            _, first, inverse = np.unique(2 * seed_idx + flip,
+                                          return_index=True,
+                                          return_inverse=True)
+            vprior = grid.prior_direction(new_index[first], flip[first])
+            vout = np.vstack([vout, vprior[inverse].astype(dtype)])
+            if recurrent:
+                rnn_states = [np.vstack([s, new]) for s, new in
+                              zip(rnn_states, model.zero_states(len(gidx)))]
+            if loop_slots > 0:
+                new_visited = np.full([len(gidx), loop_slots], -1, "int64")
+                new_voxel = np.full(len(gidx), -1, dtype="int64")
+                revisited(new_visited, new_voxel, new_index)
+                visited = np.vstack([visited, new_visited])
+                voxel = np.hstack([voxel, new_voxel])
+
+        if reorder_every > 0 and step % reorder_every == 0:
+            # Active fibers drift apart, restore their spatial order
+            perm = morton_order(fiber_ijk)
+            trajectories.permute(perm)
+            vout = vout[perm]
+            fiber_idx = fiber_idx[perm]
+            fiber_flip = fiber_flip[perm]
+            fiber_ijk = fiber_ijk[perm]
+            rnn_states = [s[perm] for s in rnn_states]
+            if loop_slots > 0:
+                visited = visited[perm]
+                voxel = voxel[perm]
+
+        # Latest point of each fiber
+        last = trajectories.last()
+        n_ongoing = len(last)
+
+        vin = vout
+
+        if config.get('predict_fn') == "sample":
+            # One random stream per seed, direction and step
+            uniforms = seeded_uniform(config.get("rng_seed", 3), [
+                fiber_idx, fiber_flip, trajectories.cursor[:n_ongoing]])
+
+        # Fiber groups are pipelined: while the model runs on one group, the
+        # features of the next and the termination of the previous are done
+        bounds = np.unique(np.linspace(0, n_ongoing, n_groups + 1).astype(int))
+        groups = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+        def prepare(g):
+            group = groups[g]
+            ijk = fiber_ijk[group]
+            vin_g = vin[group]
+            lookup, shared = None, None
+            if lut is not None:
+                # Only distinct (voxel, direction cell) pairs missing in the
+                # table are predicted, at the cell centers
+                lookup = lut.lookup(ijk, vin_g)
+                ijk, vin_g = lookup[-2], lookup[-1].astype(dtype)
+            elif samples_per_seed > 1 and not recurrent:
+                # Samples of a seed that did not move yet have the same
+                # inputs, each row is predicted from inputs[shared[row]]
+                fresh = trajectories.cursor[group] == 1
+                if fresh.any():
+                    rows = np.arange(group.start, group.stop)
+                    keys = np.where(fresh, 2 * (fiber_idx[rows] //
+                        samples_per_seed) + fiber_flip[rows], -1 - rows)
+                    _, first, shared = np.unique(keys, return_index=True,
+                                                 return_inverse=True)
+                    ijk, vin_g = ijk[first], vin_g[first]
+            if split is None:
+                d, dnorm = gather.features(ijk)
+                return lookup, shared, vin_g, np.hstack([vin_g, d, dnorm])
+            else:
+                # Only the vin part of the first layer is computed per step
+                return lookup, shared, vin_g, projection(ijk)
+
+        def predict(g, prepared):
+            lookup, shared, vin_g, inputs = prepared
+            group = groups[g]
+            evaluated[g] = len(inputs)
+
+            chunk = 2**16  # 32768
+            n_chunks = np.ceil(len(inputs) / chunk).astype(int)
+            n_rows = len(inputs) if shared is None else len(shared)
+            vout = np.zeros([n_rows, 3 + with_kappa], dtype=dtype)
+            for c in range(n_chunks):
+                if shared is None:
+                    rows, index = slice(c * chunk, (c + 1) * chunk), None
+                else:
+                    # Rows of the group whose inputs are in this chunk
+                    rows = np.flatnonzero(shared // chunk == c)
+                    index = shared[rows] - c * chunk
+
+                def expand(v):
+                    return v if index is None else v[index]
+
+                if recurrent:
+                    # Gather the states of the rows, and scatter them back
+                    states = slice(group.start + c * chunk,
+                                   min(group.start + (c + 1) * chunk,
+                                       group.stop))
+                    outputs, new_states = model(
+                        inputs[c * chunk : (c + 1) * chunk],
+                        [s[states] for s in rnn_states])
+                    for s, new in zip(rnn_states, new_states):
+                        s[states] = new
+                elif split is None:
+                    outputs = model(inputs[c * chunk : (c + 1) * chunk])
+                else:
+                    outputs = split(vin_g[c * chunk : (c + 1) * chunk],
+                                    inputs[c * chunk : (c + 1) * chunk])
+
+                if with_kappa:
+                    kappa = expand(concentration(outputs))[:, np.newaxis]
+
+                if isinstance(outputs, list):
+                    outputs = outputs[0]
+
+                if not 'predict_fn' in config:
+                    v = expand(to_numpy(outputs))
+                elif config['predict_fn'] == "mean":
+                    # Pruned models return the mean direction itself
+                    v = expand(to_numpy(getattr(outputs, "mean_direction",
+                                                outputs)))
+                    # v = normalize(v)
+                elif lut is not None:
+                    # Cached are the parameters, sampled below
+                    v = to_numpy(outputs.mean_direction)
+                elif config['predict_fn'] == "sample":
+                    v = sample(outputs, uniforms[group][rows], index)
+                vout[rows, :3] = v
+                if with_kappa:
+                    vout[rows, 3:] = kappa
+
+            if lookup is not None:
+                vout = lut.complete(lookup, vout).astype(dtype, copy=False)
+                if config.get('predict_fn') == "sample":
+                    vout[:, :3] = sample_fvm(vout[:, :3], vout[:, 3],
+                                             uniforms[group])
+            return vout
+
+        def finish(g, predicted):
+            group = groups[g]
+            vout = predicted[:, :3]
+            if max_angle > 0:
+                vout = limit_turn(vin[group], vout, max_angle)
+            kappa = predicted[:, 3] if with_kappa else None
+            step = steps(vin[group], vout, kappa)
+            rout = last[group] + step * vout
+
+            # The only affine transform of the step, also used by prepare()
+            # of the next one
+            ijk, index = grid.locate(rout)
+            stop = grid.terminated(index)
+            if stop_angle > 0:
+                # The first step may turn away from the prior
+                turn = np.sum(vin[group] * vout, axis=1)
+                stop |= ((turn < np.cos(np.radians(stop_angle)))
+                         & (trajectories.cursor[group] > 1))
+            if loop_slots > 0:
+                # Groups are disjoint rows, updated in place by each thread
+                stop |= revisited(visited[group], voxel[group], index)
+            return vout, rout, group.start + np.flatnonzero(stop), step, ijk
+
+        # Rows sent to the model per group, cache hits and shared rows are
+        # not evaluated
+        evaluated = np.zeros(len(groups), dtype=int)
+        results = pipeline(len(groups), prepare, predict, finish,
+                           executor=executor, timer=timer)
+
+        vout = np.vstack([r[0] for r in results])
+        rout = np.vstack([r[1] for r in results])
+        terminal_indices = np.concatenate([r[2] for r in results])
+        fiber_ijk = np.vstack([r[4] for r in results])
+        step_lengths = np.concatenate([
+            np.broadcast_to(r[3], [len(r[0]), 1]) for r in results])[:, 0]
+        n_steps += n_ongoing
+        n_evaluations += evaluated.sum()
+        step_length += step_lengths.sum()
+
+        trajectories.append(rout)
+
+        with timer("bookkeeping"):
+            # Fibers which did not terminate within max_steps, or grew
+            # longer than max_length (both halves), are discarded
+            exhausted = trajectories.cursor[:n_ongoing] > config['max_steps']
+            exhausted[terminal_indices] = False
+            if max_length is not None:
+                np.add.at(fiber_length, fiber_idx, step_lengths)
+                exhausted |= fiber_length[fiber_idx] > max_length
+            stitcher.fail(fiber_idx[exhausted])
+
+            ends, lengths = trajectories.get(terminal_indices)
+            stitcher.add(ends, lengths, fiber_idx[terminal_indices],
+                         fiber_flip[terminal_indices])
+
+            # The other half of a failed fiber is not needed anymore
+            dropped = np.flatnonzero(stitcher.failed[fiber_idx])
+            dst, src = trajectories.remove(
+                np.union1d(terminal_indices, dropped))
+            for arr in [vout, fiber_idx, fiber_flip, fiber_ijk, visited,
+                        voxel] + rnn_states:
+                if len(arr) > 0:
+                    arr[dst] = arr[src]
+            vout = vout[:len(trajectories)]
+            fiber_idx = fiber_idx[:len(trajectories)]
+            fiber_flip = fiber_flip[:len(trajectories)]
+            fiber_ijk = fiber_ijk[:len(trajectories)]
+            rnn_states = [s[:len(trajectories)] for s in rnn_states]
+            visited = visited[:len(trajectories)]
+            voxel = voxel[:len(trajectories)]
+
+        n_done = queue.n_taken - len(trajectories)
+        step += 1
+
+        if write is not None and step % config.get("flush_every", 100) == 0:
+            n_flushed = flush()
+
+            if checkpoint is not None and checkpoint.due():
+                with timer("checkpoint"):
+                    points, cursor = trajectories.get(
+                        np.arange(len(trajectories)))
+                    checkpoint.save(
+                        step=step, n_flushed=n_flushed,
+                        n_taken=queue.n_taken, order=queue.order,
+                        points=points, cursor=cursor, vout=vout,
+                        fiber_idx=fiber_idx, fiber_flip=fiber_flip,
+                        fiber_length=fiber_length, visited=visited,
+                        voxel=voxel, **{"rnn_state_{}".format(i): s
+                                        for i, s in enumerate(rnn_states)},
+                        **stitcher.state())
+
+        print("Iter {:4d}, {:6d} active, finished {:5d}/{:5d} ({:3.0f}%) of all"
+              " seeds with {:6.0f} steps/sec".format(step, n_ongoing,
+                                                      n_done, n_seeds,
+                                                      100*n_done/n_seeds,
+                                                      n_ongoing / (time() - t0)),
+              end="\r")
 
-        d = np.zeros([n_ongoing, block_size, block_size, block_size, dwi.shape[-1]])
-        for idx in range(block_size**3):
-            ii,jj,kk = np.unravel_index(idx, (block_size, block_size, block_size))
-            d[:, ii, jj, kk, :] = dwi[i+ii-1, j+jj-1, k+kk-1, :]
-        d = d.reshape(-1, dwi.shape[-1] * block_size**3)
+        # A full collection takes long with TensorFlow loaded
+        if step % config.get("flush_every", 100) == 0:
+            gc.collect()
+
+    if executor is not None:
+        executor.shutdown()
+    if write is not None:
+        flush()
+    print("\nStage times: " + timer.summary())
+    print("{} model evaluations for {} steps, mean step {:.3f} mm".format(
+        n_evaluations, n_steps, step_length / max(n_steps, 1)))
+    if stats is not None:
+        stats["steps"] = stats.get("steps", 0) + n_steps
+        stats["evaluations"] = stats.get("evaluations", 0) + n_evaluations
+    if lut is not None:
+        print("Prediction cache: " + lut.summary())
+
+    return stitcher.fibers
+
+
+def track_shard(config, seed_range, volume_path, grid, shard_path):
+    """Worker process of run_inference with config['n_workers'] > 1.
+
+    Tracks seeds[seed_range[0]:seed_range[1]] with its own model copy, using
+    the padded DWI memory-mapped from volume_path and the VoxelGrid grid, and
+    saves the fibers with their seed indices to shard_path.
+    """
+    threads = max(1, os.cpu_count() // config['n_workers'])
+    if config.get("engine", "keras") == "numpy":
+        set_blas_threads(threads)
+    else:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
 
-        dnorm = np.linalg.norm(d, axis=1, keepdims=True) + 10**-2
-        d /= dnorm
+    model = load_tracker(config)
 
-        if step == 0:
-            inputs = np.hstack([prior(xyz[:, 0, :]), d, dnorm])
-        else:
-            inputs = np.hstack([vout, d, dnorm])
+    volume = np.load(volume_path, mmap_mode="r")
+    gather, split, projection = make_gather(config, model, volume, grid,
+                                            padded=True)
 
-        chunk = 2**16  # 32768
-        n_chunks = np.ceil(n_ongoing / chunk).astype(int)
-        vout = np.zeros([n_ongoing, 3])
-        for c in range(n_chunks):
+    seeds = nib.streamlines.load(config['seed_path']).tractogram.streamlines.data
 
-            outputs = model(inputs[c * chunk : (c + 1) * chunk])
+    stats = {}
+    fibers = track(config, model, gather, split, projection, grid, seeds,
+                   order=np.arange(*seed_range), stats=stats)
 
-            if isinstance(outputs, list):
-                outputs = outputs[0]
+    np.savez(shard_path,
+             data=fibers.data, lengths=fibers.lengths, ids=fibers.ids,
+             **stats)
 
-            if not 'predict_fn' in config:
-                v = outputs
-            elif config['predict_fn'] == "mean":
-                v = outputs.mean_direction.numpy()
-                # v = normalize(v)
-            elif config['predict_fn'] == "sample":
-                v = outputs.sample().numpy()
-            vout[c * chunk : (c + 1) * chunk] = v
 
-        rout = xyz[:, -1, :3] + config['step_size'] * vout
-        rout = np.hstack([rout, np.ones((n_ongoing, 1))]).reshape(-1, 1, 4)
+def track_sharded(config, model, dwi, grid, n_seeds, stats=None):
+    """Split the seeds over config['n_workers'] processes, and merge them.
+    stats is updated with their steps and evaluations, see track().
 
-        xyz = np.concatenate([xyz, rout], axis=1)
+    The workers share one memory-mapped, padded DWI (and the feature tables,
+    if enabled), which are prepared here before the workers start.
+    """
+    n_workers = config['n_workers']
 
-        terminal_indices = terminator(xyz[:, -1, :])
+    cache_dir = (config.get("cache_dir") or
+                 cache_dir_for(config['dwi_path'], "feature_tables"))
+    block_size = get_blocksize(model, dwi.shape[-1])
+    volume_path = os.path.join(cache_dir, "padded_{}.npy".format(
+        cache_key(config['dwi_path'], block_size)))
 
-        for idx in terminal_indices:
-            gidx = fiber_idx[idx]
-            # Other end not yet added
-            if not fibers[gidx]:
-                fibers[gidx].append(np.copy(xyz[idx, :, :3]))
-            # Other end already added
-            else:
-                this_end = xyz[idx, :, :3]
-                other_end = fibers[gidx][0]
-                merged_fiber = np.vstack([
-                    np.flip(this_end[1:], axis=0),
-                    other_end]) # stitch ends together
-                fibers[gidx] = [merged_fiber]
+    print("Preparing shared DWI...")
+    volume = padded_volume(dwi, block_size, volume_path)
+    make_gather(config, model, volume, grid, padded=True)
 
-        xyz = np.delete(xyz, terminal_indices, axis=0)
-        vout = np.delete(vout, terminal_indices, axis=0)
-        fiber_idx = np.delete(fiber_idx, terminal_indices)
+    bounds = np.linspace(0, n_seeds, n_workers + 1).astype(int)
+    shard_dir = tempfile.mkdtemp(dir=cache_dir)
+    shard_paths = [os.path.join(shard_dir, "shard_{}.npz".format(i))
+                   for i in range(n_workers)]
 
-        print("Iter {:4d}/{}, finished {:5d}/{:5d} ({:3.0f}%) of all seeds with"
-              " {:6.0f} steps/sec".format((step+1), config['max_steps'],
-                                          n_seeds-n_ongoing, n_seeds,
-                                          100*(1-n_ongoing/n_seeds),
-                                          n_ongoing / (time() - t0)),
-              end="\r")
+    ctx = multiprocessing.get_context("spawn")
+    procs = []
+    try:
+        for i in range(n_workers):
+            p = ctx.Process(target=track_shard, args=(
+                config, (bounds[i], bounds[i+1]), volume_path, grid,
+                shard_paths[i]))
+            p.start()
+            procs.append(p)
+
+        for p in procs:
+            p.join()
+            if p.exitcode != 0:
+                raise RuntimeError("Tracking worker failed with exit code "
+                                   "{}".format(p.exitcode))
+
+        fibers = StreamlineBuffer(dtype=config.get("precision", "float32"))
+        for path in shard_paths:
+            with np.load(path) as shard:
+                fibers.extend(shard["data"], shard["lengths"], shard["ids"])
+                if stats is not None:
+                    for key in ["steps", "evaluations"]:
+                        stats[key] = stats.get(key, 0) + int(shard[key])
+    finally:
+        # No orphaned workers or partial shards after a failure
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        shutil.rmtree(shard_dir, ignore_errors=True)
 
-        if n_ongoing == 0:
-            break
+    return fibers
 
-        gc.collect()
 
-    # Exclude unfinished fibers (finished = both ends finished)
-    fibers = [fibers[gidx] for gidx in range(len(fibers)) if gidx not in fiber_idx]
+@setup_env
+def run_inference(config=None, gpu_queue=None, return_to=None):
 
-    # Save Result
+    """"""
+    gpu_idx = -1
+    try:
+        gpu_idx = maybe_get_a_gpu() if gpu_queue is None else gpu_queue.get()
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_idx
+    except Exception as e:
+        print(str(e))
 
-    fibers = [f[0] for f in fibers]
+    print("Loading Models...") #################################################
 
-    tractogram = Tractogram(
-        streamlines=ArraySequence(fibers),
-        affine_to_rasmm=np.eye(4)
-    )
+    train_config_path = os.path.join(
+        os.path.dirname(config['model_path']), "config.yml")
 
-    tractogram = add_tangent(
-        tractogram,
-        min_length=config["min_length"],
-        max_length=config["max_length"]
-    )
+    model = load_tracker(config)
 
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-    out_dir = os.path.join(os.path.dirname(config["dwi_path"]),
-        "predicted_fibers", timestamp)
+    print("Loading DWI...") ####################################################
+
+    dwi, dwi_aff = load_volume(config['dwi_path'], canonical=True,
+                               dtype=config.get("precision", "float32"))
+
+    ############################################################################
+
+    terminator = Terminator(config['term_path'], config['thresh'])
+
+    prior = Prior(config['prior_path'])
+
+    seed_file = nib.streamlines.load(config['seed_path'])
+    seeds = seed_file.tractogram.streamlines.data
+
+    if config.get("resume"):
+        out_dir = config["resume"]
+        timestamp = os.path.basename(os.path.normpath(out_dir))
+    else:
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+        out_dir = os.path.join(os.path.dirname(config["dwi_path"]),
+            "predicted_fibers", timestamp)
 
     configs.deep_update(config, {"out_dir": out_dir})
 
     os.makedirs(out_dir, exist_ok=True)
 
     fiber_path = os.path.join(out_dir, timestamp + ".trk")
-    print("\nSaving {}".format(fiber_path))
-    TrkFile(tractogram, seed_file.header).save(fiber_path)
 
+    # Saved before tracking, such that a killed run can be resumed with it
     config['training_config'] = load(train_config_path)
     repo = git.Repo(".")
     commit = repo.head.commit
     config['commit'] = str(commit)
     config_path = os.path.join(out_dir, "config.yml")
-    print("Saving {}".format(config_path))
-    with open(config_path, "w") as file:
-        yaml.dump(config, file, default_flow_style=False)
+
+    def save_config():
+        print("Saving {}".format(config_path))
+        with open(config_path, "w") as file:
+            yaml.dump(config, file, default_flow_style=False)
+
+    save_config()
+
+    # Save Result, only finished fibers (both ends finished) in seed order.
+    # They are appended to fiber_path while tracking, which can be loaded
+    # any time for the partial result.
+    writer = TrkStreamWriter(fiber_path, seed_file.header)
+
+    # Periodically saved tracking state, to continue with --resume out_dir
+    checkpoint = Checkpoint(os.path.join(out_dir, "checkpoint.npz"),
+                            writer=writer,
+                            every=config.get("checkpoint_every", 300))
+
+    n_points, n_fibers = [0], [0]
+    samples_per_seed = config.get("samples_per_seed", 1)
+
+    def write(streamlines, ids):
+        n_points[0] += int(streamlines.total_nb_rows)
+        n_fibers[0] += len(streamlines)
+        data_per_streamline = {}
+        if samples_per_seed > 1:
+            # Index in seed_path, shared by the samples of a seed
+            data_per_streamline["seed_id"] = (ids // samples_per_seed)[:, None]
+        tractogram = Tractogram(
+            streamlines=streamlines,
+            data_per_streamline=data_per_streamline,
+            affine_to_rasmm=np.eye(4)
+        )
+
+        tractogram = add_tangent(
+            tractogram,
+            min_length=config["min_length"],
+            max_length=config["max_length"]
+        )
+
+        writer.write(tractogram)
+
+    print("Writing {}".format(fiber_path))
+    t0 = time()
+    grid = VoxelGrid(dwi.shape, dwi_aff, terminator, prior)
+    stats = {}
+    if config.get("n_workers", 1) > 1:
+        fibers = track_sharded(config, model, dwi, grid, len(seeds),
+                               stats=stats)
+        order = np.argsort(fibers.ids)
+        write(fibers.to_array_sequence(order=order), fibers.ids[order])
+    else:
+        gather, split, projection = make_gather(config, model, dwi, grid)
+        track(config, model, gather, split, projection, grid, seeds,
+              write=write, checkpoint=checkpoint, stats=stats)
+    writer.close()
+    checkpoint.remove()
+    print("\nSaved {} fibers".format(writer.n_written))
+
+    # Throughput of this run, for comparing models (see tradeoff_report.py)
+    seconds = float(time() - t0)
+    # Every point but the seed took one step, of which direction_lut hits
+    # and shared samples took no model evaluation
+    evaluated = (stats["evaluations"] / stats["steps"] if stats["steps"]
+                 else 1.0)
+    steps_per_fiber = (evaluated * (n_points[0] - n_fibers[0])
+                       / max(n_fibers[0], 1))
+    config['tracking'] = {"seconds": seconds, "points": n_points[0],
+                          "points_per_sec": n_points[0] / seconds,
+                          "steps_per_fiber": steps_per_fiber}
+    print("Tracked {} points in {:.1f}s, {:.0f} points/s, {:.1f} model "
+          "evaluations per fiber".format(n_points[0], seconds,
+                                         n_points[0] / seconds,
+                                         steps_per_fiber))
+    save_config()
 
     if config["score"]:
         score(
@@ -224,7 +767,7 @@ def run_inference(config=None, gpu_queue=None, return_to=None):
         
     # Return GPU
 
-    K.clear_session()
+    clear_session()
     if gpu_queue is not None:
         gpu_queue.put(gpu_idx)
 
@@ -237,15 +780,35 @@ def run_inference(config=None, gpu_queue=None, return_to=None):
     return fiber_path
 
 
-def infere_batch_seed(xyz, prior, terminator, model,
-                      dwi, dwi_affi, max_steps, step_size, model_name=''):
+def rnn_batch(seeds, prior, n_rows):
+    """Both directions of the seeds, as (fiber, segment, coord) with the
+    affine coordinate, and their prior directions. The rows after the
+    2 * len(seeds) fibers are dummy fibers at the first seed, which fill the
+    fixed batch size of the stateful model."""
+    n_fibers = 2 * len(seeds)
+    xyz = np.vstack([seeds, seeds,
+                     np.repeat(seeds[:1], n_rows - n_fibers, axis=0)])
+    xyz = np.hstack([xyz, np.ones([n_rows, 1])]).reshape(-1, 1, 4)
+
+    flip = np.zeros(n_rows, dtype=bool)
+    flip[len(seeds):n_fibers] = True
+    return xyz, prior(xyz[:, 0, :], flip=flip), n_fibers
+
+
+def infere_batch_seed(xyz, vprior, n_fibers, terminator, model,
+                      neighborhood, dwi_affi, max_steps, step_size,
+                      model_name=''):
 
     n_seeds = len(xyz)
     fiber_idx = np.hstack([
-        np.arange(n_seeds//2, dtype="int32"),
-        np.arange(n_seeds//2,  dtype="int32")
+        np.arange(n_fibers//2, dtype="int32"),
+        np.arange(n_fibers//2,  dtype="int32"),
+        np.zeros(n_seeds - n_fibers, dtype="int32")
     ])
-    fibers = [[] for _ in range(n_seeds//2)]
+    stitcher = FiberStitcher(n_fibers//2)
+    # The second copy of the seeds is tracked in the flipped direction
+    rows = np.arange(n_seeds)
+    flip = (rows >= n_fibers//2) & (rows < n_fibers)
 
     def xyz2ijk(coords, snap=False):
         ijk = (coords.T).copy()
@@ -255,14 +818,11 @@ def infere_batch_seed(xyz, prior, terminator, model,
         else:
             return ijk.T
 
-    block_size = get_blocksize(model, dwi.shape[-1])
-
-    d = np.zeros([n_seeds, dwi.shape[-1] * block_size ** 3])
-    dnorm = np.zeros([n_seeds, 1])
     vout = np.zeros([n_seeds, 3])
-    already_terminated = np.empty(0, dtype="int32")
+    # Dummy fibers count as terminated from the start
+    already_terminated = np.arange(n_fibers, n_seeds, dtype="int32")
     mask = np.ones((n_seeds), dtype=bool)
-    n_ongoing = n_seeds
+    n_ongoing = n_fibers
     out_of_bound_fibers = 0
     for i in range(max_steps):
         t0 = time()
@@ -270,21 +830,14 @@ def infere_batch_seed(xyz, prior, terminator, model,
         # Get coords of latest segement for each fiber
         ijk = xyz2ijk(xyz[:, -1, :], snap=True)
 
-        for ii, idx in enumerate(ijk):
-            try:
-                d[ii] = dwi[
-                        idx[0]-(block_size // 2): idx[0]+(block_size // 2)+1,
-                        idx[1]-(block_size // 2): idx[1]+(block_size // 2)+1,
-                        idx[2]-(block_size // 2): idx[2]+(block_size // 2)+1,
-                        :].flatten()  # returns copy
-                dnorm[ii] = np.linalg.norm(d[ii]) + 0.01
-                d[ii] /= dnorm[ii]
-            except:
-                assert ii in already_terminated
-                out_of_bound_fibers = out_of_bound_fibers + 1
+        outside = np.flatnonzero(~neighborhood.inside(ijk))
+        assert np.isin(outside, already_terminated).all()
+        out_of_bound_fibers = out_of_bound_fibers + len(outside)
+
+        d, dnorm = neighborhood.features(ijk)
 
         if i == 0:
-            inputs = np.hstack([prior(xyz[:, 0, :]), d, dnorm])
+            inputs = np.hstack([vprior, d, dnorm])
         else:
             inputs = np.hstack([vout, d, dnorm])
 
@@ -310,29 +863,20 @@ def infere_batch_seed(xyz, prior, terminator, model,
         tmp_indices = terminator(xyz[mask, -1, :])
         terminal_indices = np.where(mask)[0][tmp_indices]
 
-        for idx in terminal_indices:
-            assert idx not in already_terminated
-            gidx = fiber_idx[idx]
-            # Other end not yet added
-            if not fibers[gidx]:
-                fibers[gidx].append(np.copy(xyz[idx, :, :3]))
-            # Other end already added
-            else:
-                this_end = xyz[idx, :, :3]
-                other_end = fibers[gidx][0]
-                merged_fiber = np.vstack([
-                    np.flip(this_end[1:], axis=0),
-                    other_end])  # stitch ends together
-                fibers[gidx] = [merged_fiber]
-
-            n_ongoing = n_ongoing - 1
+        n_steps = xyz.shape[1]
+        stitcher.add(xyz[terminal_indices, :, :3].reshape(-1, 3),
+                     np.full(len(terminal_indices), n_steps),
+                     fiber_idx[terminal_indices],
+                     flip[terminal_indices])
+        n_ongoing = n_ongoing - len(terminal_indices)
+
         already_terminated = np.concatenate(
             [already_terminated, terminal_indices])
 
         print("Iter {:4d}/{}, finished {:5d}/{:5d} ({:3.0f}%) of all seeds with"
               " {:6.0f} steps/sec".format((i + 1), max_steps,
-                                          n_seeds - n_ongoing, n_seeds,
-                                          100 * (1 - n_ongoing / n_seeds),
+                                          n_fibers - n_ongoing, n_fibers,
+                                          100 * (1 - n_ongoing / n_fibers),
                                           n_ongoing / (time() - t0)),
               end="\r")
 
@@ -346,10 +890,8 @@ def infere_batch_seed(xyz, prior, terminator, model,
     print("{0} times fibers got out of bound, but keep calm as they were "
           "already finished".format(out_of_bound_fibers))
 
-    # Exclude unfinished fibers:
-    fibers = [fibers[gidx] for gidx in range(len(fibers)) if
-              gidx in already_terminated]
-    return fibers
+    # Only finished fibers (both ends terminated) were stitched
+    return stitcher.fibers
 
 
 def run_rnn_inference(config, gpu_queue=None):
@@ -362,16 +904,26 @@ def run_rnn_inference(config, gpu_queue=None):
     except Exception as e:
         print(str(e))
 
+    # Volumes are loaded while the model is built
+    executor = ThreadPoolExecutor(max_workers=1)
+
     print("Loading DWI...")  ####################################################
     batch_size = config['batch_size']
-    dwi_img = nib.load(config['dwi_path'])
-    dwi_img = nib.funcs.as_closest_canonical(dwi_img)
-    dwi_aff = dwi_img.affine
-    dwi_affi = np.linalg.inv(dwi_aff)
-    dwi = dwi_img.get_data()
+    dwi = executor.submit(load_volume, config['dwi_path'], canonical=True,
+                          dtype=config.get("precision", "float32"))
+    terminator = executor.submit(Terminator, config['term_path'],
+                                 config['thresh'])
+    prior = executor.submit(Prior, config['prior_path'])
+
+    seed_file = nib.streamlines.load(config['seed_path'])
+    xyz = seed_file.tractogram.streamlines.data
+    n_seeds = len(xyz)
 
     print("Loading Models...")  #################################################
 
+    from tensorflow.keras.models import load_model
+    from models import MODELS
+
     train_config_path = os.path.join(
         os.path.dirname(config['model_path']), "config.yml")
 
@@ -385,58 +937,56 @@ def run_rnn_inference(config, gpu_queue=None):
     else:
         trained_model = load_model(config['model_path'], compile=False)
 
-    model_config = {'batch_size': batch_size,
+    # Built once, the remaining batch is padded with dummy fibers
+    seeds_per_batch = min(batch_size // 2, n_seeds)
+    model_config = {'batch_size': 2 * seeds_per_batch,
                     'input_shape':  trained_model.input_shape[1:],
                     'temperature': 0.04}
     prediction_model = MODELS[model_name](model_config).keras
     prediction_model.set_weights(trained_model.get_weights())
 
-    terminator = Terminator(config['term_path'], config['thresh'])
+    dwi, dwi_aff = dwi.result()
+    dwi_affi = np.linalg.inv(dwi_aff)
+    terminator, prior = terminator.result(), prior.result()
 
-    prior = Prior(config['prior_path'])
+    # Padded once for all batches
+    neighborhood = Neighborhood(dwi, get_blocksize(prediction_model,
+                                                   dwi.shape[-1]))
 
     print("Initializing Fibers...")  ############################################
 
-    seed_file = nib.streamlines.load(config['seed_path'])
-    xyz = seed_file.tractogram.streamlines.data
-    n_seeds = len(xyz)
-    fibers = [[] for _ in range(n_seeds)]
-
-    for i in range(0, n_seeds, batch_size // 2):
-        xyz_batch = xyz[i:i + batch_size // 2]
-
-        n_seeds_batch = 2 * len(xyz_batch)
-        # Duplicate seeds for both directions
-        xyz_batch = np.vstack([xyz_batch, xyz_batch])
-        # add affine dimension
-        xyz_batch = np.hstack([xyz_batch, np.ones([n_seeds_batch, 1])])
-        # (fiber, segment, coord)
-        xyz_batch = xyz_batch.reshape(-1, 1, 4)
-
-        # Make a last model for the remaining batch
-        if i == batch_size//2 * (n_seeds // (batch_size // 2)):
-            last_batch_size = (n_seeds - i) * 2
-            model_config['batch_size'] = last_batch_size
-            prediction_model = MODELS[model_name](model_config).keras
-            prediction_model.set_weights(trained_model.get_weights())
+    fibers = StreamlineBuffer()
+
+    starts = range(0, n_seeds, seeds_per_batch)
+
+    def prepare(i):
+        return rnn_batch(xyz[i:i + seeds_per_batch], prior,
+                         2 * seeds_per_batch)
+
+    # The next batch is prepared while the current one is tracked
+    batch = executor.submit(prepare, starts[0])
+    for k, i in enumerate(starts):
+        xyz_batch, vprior, n_fibers = batch.result()
+        if k + 1 < len(starts):
+            batch = executor.submit(prepare, starts[k + 1])
 
         prediction_model.reset_states()
-        print("Batch {0} with shape {1}".format(
-            i // (batch_size // 2), xyz_batch.shape))
-        batch_fibers = infere_batch_seed(xyz_batch, prior, terminator,
-            prediction_model, dwi, dwi_affi, config['max_steps'],
-                                         config['step_size'], model_name=model_name)
-        fibers[i:i+batch_size//2] = batch_fibers
+        print("Batch {0} with {1} fibers".format(k, n_fibers))
+        batch_fibers = infere_batch_seed(xyz_batch, vprior, n_fibers,
+            terminator, prediction_model, neighborhood, dwi_affi,
+            config['max_steps'], config['step_size'], model_name=model_name)
+        fibers.extend(batch_fibers.data, batch_fibers.lengths,
+                      batch_fibers.ids + i)
 
-    # Save Result
-    fibers = [f[0] for f in fibers if len(f) > 0]
+    executor.shutdown()
 
+    # Save Result, in seed order
     tractogram = Tractogram(
-        streamlines=ArraySequence(fibers),
+        streamlines=fibers.to_array_sequence(order=np.argsort(fibers.ids)),
         affine_to_rasmm=np.eye(4)
     )
 
-    K.clear_session()
+    clear_session()
     if gpu_queue is not None:
         gpu_queue.put(gpu_idx)
 
@@ -483,11 +1033,19 @@ if __name__ == '__main__':
     parser.add_argument("config_path", type=str, nargs="?",
                         help="Path to inference config.")
 
+    parser.add_argument("--resume", type=str,
+                        help="Output directory of a killed run, to continue "
+                        "from its last checkpoint.")
+
     args, more_args = parser.parse_known_args()
 
+    if args.config_path is None and args.resume is not None:
+        args.config_path = os.path.join(args.resume, "config.yml")
+
     config = configs.compile_from(args.config_path, args, more_args)
 
-    if config['model_name'].startswith("RNN"):
+    if (config['model_name'].startswith("RNN") and
+            config.get("rnn_engine", "stateful") == "batch"):
         run_rnn_inference(config)
     else:
         run_inference(config)
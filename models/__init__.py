@@ -4,20 +4,23 @@ from utils.config import load
 from tensorflow.keras.models import load_model as keras_load_model
 
 from .model_classes import FvM, FvMHybrid, RNNGRU, Entrack, RNNLSTM, Detrack, \
-    Trackifier, RNNGRUEntrack, RNNLSTMEntrack
+    Trackifier, RNNGRUEntrack, RNNLSTMEntrack, EntrackStudent
+from .surgery import inference_model
 
 MODELS = {"FvM": FvM,
           "Detrack": Detrack,
           "FvMHybrid": FvMHybrid,
           "RNNGRU": RNNGRU,
           "Entrack": Entrack,
+          "EntrackStudent": EntrackStudent,
           'RNNLSTM': RNNLSTM,
           'Trackifier': Trackifier,
           'RNNGRUEntrack': RNNGRUEntrack,
           'RNNLSTMEntrack': RNNLSTMEntrack}
 
 
-def load_model(model_path):
+def load_model(model_path, outputs="full"):
+    """Load a trained model, see surgery.inference_model for outputs."""
 
     model_config_path = os.path.join(
         os.path.dirname(model_path), "config.yml")
@@ -25,8 +28,10 @@ def load_model(model_path):
     model_name = load(model_config_path, "model_name")
 
     if hasattr(MODELS[model_name], "custom_objects"):
-        return keras_load_model(model_path,
+        model = keras_load_model(model_path,
                            custom_objects=MODELS[model_name].custom_objects,
                            compile=False)
     else:
-        return keras_load_model(model_path, compile=False)
\ No newline at end of file
+        model = keras_load_model(model_path, compile=False)
+
+    return inference_model(model, outputs)
@@ -1,3 +1,5 @@
+import os
+
 from abc import abstractmethod
 from os.path import isdir
 import tensorflow as tf
@@ -65,6 +67,27 @@ def neg_dot_prod(y_true, y_pred):
     return - K.sum(y_true * y_pred, axis=1)
 
 
+def fvm_kl_divergence(y_true, dist_pred):
+    """KL(teacher || dist_pred), for teacher FvM parameters y_true = [mu, kappa]"""
+    teacher = FisherVonMises(
+        mean_direction=y_true[:, :3], concentration=y_true[:, 3])
+    return (
+        dist_pred._log_normalization() - teacher._log_normalization()
+        + K.sum(teacher.mean() * (
+            teacher.mean_direction * teacher.concentration[:, tf.newaxis]
+            - dist_pred.mean_direction * dist_pred.concentration[:, tf.newaxis]
+            ), axis=1)
+    )
+
+
+def mean_fvm_kl_divergence(y_true, dist_pred):
+    return K.mean(fvm_kl_divergence(y_true, dist_pred))
+
+
+def mean_neg_teacher_dot_prod(y_true, y_pred):
+    return mean_neg_dot_prod(y_true[:, :3], y_pred)
+
+
 class OneHotCategorical(tfd.OneHotCategorical):
 
     def __init__(self, bvecs_path, *args, **kwargs):
@@ -527,6 +550,66 @@ class Entrack(Model):
         assert config["temperature"] > 0
 
 
+class EntrackStudent(Entrack):
+    """Smaller Entrack, trained on the mu and kappa of a trained teacher.
+
+    The trunk and head widths are set by config["trunk_widths"] and
+    config["head_widths"]. Inputs and outputs are those of Entrack, such
+    that the student replaces its teacher everywhere.
+    """
+    model_name = "EntrackStudent"
+
+    sample_class = "DistillSamples"
+
+    custom_objects = {
+            "mean_fvm_kl_divergence": mean_fvm_kl_divergence,
+            "mean_neg_teacher_dot_prod": mean_neg_teacher_dot_prod,
+            "kappa_mean": mean,
+            "DistributionLambda": tfp.layers.DistributionLambda
+        }
+
+    def __init__(self, config):
+        self.trunk_widths = config.get("trunk_widths", [512, 512])
+        self.head_widths = config.get("head_widths", [256])
+        # The entropy regularization is already in the teacher's kappa
+        config.setdefault("temperature", 0.0)
+        super(EntrackStudent, self).__init__(config)
+
+    def _shared_layers(self, inputs):
+        x = inputs
+        for width in self.trunk_widths:
+            x = Dense(width, activation="relu")(x)
+        return x
+
+    def kappa(self, x):
+        for width in self.head_widths:
+            x = Dense(width, activation="relu")(x)
+        kappa = Dense(1, activation="relu")(x)
+        kappa = Lambda(lambda t: K.squeeze(t, 1) + 0.001, name="kappa")(kappa)
+        return kappa
+
+    def mu(self, x):
+        for width in self.head_widths:
+            x = Dense(width, activation="relu")(x)
+        mu = Dense(3, activation="linear")(x)
+        mu = Lambda(lambda t: K.l2_normalize(t, axis=-1), name="mu")(mu)
+        return mu
+
+    def compile(self, optimizer):
+        self.keras.compile(
+            optimizer=optimizer,
+            loss={"fvm": self.custom_objects["mean_fvm_kl_divergence"]},
+            metrics={"fvm": self.custom_objects["mean_neg_teacher_dot_prod"],
+                     "kappa": self.custom_objects["kappa_mean"]}
+        )
+
+    @staticmethod
+    def check(config):
+        """Assert model specific parameters"""
+        assert "teacher_path" in config
+        assert os.path.exists(config["teacher_path"])
+
+
 class RNNEntrack(Entrack):
     """docstring for RNNEntrack"""
     model_name = "RNNEntrack"
@@ -0,0 +1,190 @@
+import numpy as np
+import tensorflow as tf
+
+from tensorflow.keras.layers import Input, Dense, InputLayer, Reshape, RNN
+from tensorflow.keras import Model as KerasModel
+
+
+def downstream_model(model, layer, name=None):
+    """Rebuild the graph of model downstream of layer, with a new input.
+
+    The returned model takes the output of layer as its input, and shares all
+    weights with model.
+    """
+    inputs = Input(shape=layer.output.shape[1:], name="tail_inputs")
+
+    tensors = {id(layer.output): inputs}
+    for l in model.layers:
+        if l is layer or isinstance(l, InputLayer):
+            continue
+        if isinstance(l.input, (list, tuple)):
+            if not all(id(t) in tensors for t in l.input):
+                continue
+            tensors[id(l.output)] = l([tensors[id(t)] for t in l.input])
+        elif id(l.input) in tensors:
+            tensors[id(l.output)] = l(tensors[id(l.input)])
+
+    outputs = [tensors[id(model.get_layer(output_name).output)]
+               for output_name in model.output_names]
+    if len(outputs) == 1:
+        outputs = outputs[0]
+
+    return KerasModel(inputs, outputs, name=name or model.name + "_tail")
+
+
+def inference_model(model, outputs="full"):
+    """Sub-model that only computes the given outputs, for inference.
+
+    outputs is "mu", "mu_kappa" or "full". The first two return the plain
+    tensors of the "mu" (and "kappa") layers, and drop all layers that are
+    not needed for them, e.g. the kappa head and the FvM distribution with
+    outputs="mu". "full" returns model itself.
+    """
+    if outputs == "full":
+        return model
+
+    names = outputs.split("_")
+    layer_names = [l.name for l in model.layers]
+    if not all(name in layer_names for name in names):
+        raise ValueError("{} has no outputs {}, choose from 'mu', 'mu_kappa' "
+                         "or 'full'".format(model.name, outputs))
+
+    tensors = [model.get_layer(name).output for name in names]
+    if len(tensors) == 1:
+        tensors = tensors[0]
+
+    return KerasModel(model.inputs, tensors,
+                      name="{}_{}".format(model.name, outputs))
+
+
+def first_dense(model):
+    """The Dense layer that consumes the model inputs."""
+    for layer in model.layers:
+        if isinstance(layer, Dense) and layer.input is model.inputs[0]:
+            return layer
+    raise ValueError("{} does not start with a Dense layer".format(model.name))
+
+
+class FirstLayerSplit(object):
+    """Model with the first Dense kernel split into a vin and a voxel part.
+
+    For inputs [vin, d, dnorm], the first layer computes
+        act(vin · W_vin + [d, dnorm] · W_voxel + b),
+    where the second term only depends on the voxel, and can be precomputed
+    (see utils.prediction.ProjectionTable). Calling the split model with vin
+    and that projection gives the outputs of the full model.
+    """
+
+    def __init__(self, model, n_vin=3):
+        dense = first_dense(model)
+        weights = dense.get_weights()
+        kernel = weights[0].astype("float32")
+
+        self.kernel_vin = kernel[:n_vin]
+        self.kernel_voxel = kernel[n_vin:]
+        self.bias = weights[1].astype("float32") if dense.use_bias else 0
+        self.activation = dense.activation
+        self.tail = downstream_model(model, dense)
+
+    def project(self, features):
+        return np.dot(features.astype("float32", copy=False),
+                      self.kernel_voxel)
+
+    def __call__(self, vin, projection):
+        h = projection + np.dot(vin.astype("float32", copy=False),
+                                self.kernel_vin)
+        h += self.bias
+        return self.tail(self.activation(h))
+
+
+def is_recurrent(model):
+    return any(isinstance(l, RNN) for l in model.layers)
+
+
+def recurrent_step_model(model):
+    """Rebuild a model with stateful RNN layers for a single time step.
+
+    The returned model takes inputs of shape (batch, features), followed by
+    the state of every RNN layer, and returns the outputs of model followed
+    by the new states. Its batch size is free, and it shares all weights
+    with model. Also returns the sizes of the states.
+    """
+    n_features = model.inputs[0].shape[-1]
+    inputs = Input(shape=(n_features,), name="step_inputs")
+
+    state_inputs, state_outputs, state_sizes = [], [], []
+    tensors = {id(model.inputs[0]): inputs}
+    for l in model.layers:
+        if isinstance(l, InputLayer):
+            continue
+        if isinstance(l.input, (list, tuple)):
+            x = [tensors[id(t)] for t in l.input]
+        else:
+            x = tensors[id(l.input)]
+
+        if isinstance(l, RNN):
+            # A sequence of one step, whose state comes from the inputs
+            config = l.get_config()
+            config.update(stateful=False, return_sequences=False,
+                          return_state=True)
+            step = l.__class__.from_config(config)
+
+            sizes = l.cell.state_size
+            sizes = list(sizes) if isinstance(sizes, (list, tuple)) \
+                else [sizes]
+            states = [Input(shape=(size,)) for size in sizes]
+
+            x = Reshape((1, x.shape[-1]))(x)
+            y = step(x, initial_state=states)
+            step.set_weights(l.get_weights())
+
+            tensors[id(l.output)] = y[0]
+            state_inputs += states
+            state_outputs += y[1:]
+            state_sizes += sizes
+        else:
+            tensors[id(l.output)] = l(x)
+
+    outputs = [tensors[id(model.get_layer(output_name).output)]
+               for output_name in model.output_names]
+
+    step_model = KerasModel([inputs] + state_inputs, outputs + state_outputs,
+                            name=model.name + "_step")
+    return step_model, state_sizes
+
+
+class RecurrentStep(object):
+    """A model with stateful RNN layers, called one step at a time with the
+    states of the given fibers only.
+
+    Instead of Keras' fixed-size stateful batches, the states are kept by
+    the caller, e.g. one row per active fiber, which are gathered for the
+    fibers that are tracked, and scattered back after the step.
+    """
+
+    def __init__(self, model):
+        self.name = model.name
+        self.input_dim = int(model.inputs[0].shape[-1])
+        self.model, self.state_sizes = recurrent_step_model(model)
+
+        # Traced once for all batch sizes, which saves most of the per call
+        # overhead. Distributions would be converted to tensors by tracing.
+        self.call = self.model
+        kinds = [type(model.get_layer(name)).__name__
+                 for name in model.output_names]
+        if "DistributionLambda" not in kinds:
+            self.call = tf.function(self.model, reduce_retracing=True)
+
+    def zero_states(self, n):
+        return [np.zeros([n, size], dtype="float32")
+                for size in self.state_sizes]
+
+    def __call__(self, inputs, states):
+        """Outputs of the model for inputs (n, features), and the new
+        states, given the states of the same n fibers."""
+        results = self.call([np.asarray(inputs, dtype="float32")] +
+                            list(states))
+        n_outputs = len(results) - len(self.state_sizes)
+        outputs = results[:n_outputs]
+        states = [state.numpy() for state in results[n_outputs:]]
+        return outputs[0] if n_outputs == 1 else outputs, states
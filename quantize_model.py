@@ -0,0 +1,116 @@
+import os
+import argparse
+
+import numpy as np
+
+from utils.cache import load_volume
+from utils.numpy_model import load_numpy_model, numpy_model_path, WEIGHTS
+from utils.prediction import Neighborhood, get_blocksize
+
+
+def shard_inputs(model, sample_path, n_samples, seed=3):
+    """Model inputs of a generate_samples.py shard, as DistillSamples reads
+    them, i.e. incoming directions along the streamlines the samples were
+    taken from. A random subset of n_samples, if the shard is larger."""
+    with np.load(sample_path, allow_pickle=True) as samples:
+        inputs = samples["inputs"]
+    if inputs.ndim != 2 or inputs.shape[1] != model.input_dim:
+        raise ValueError("{} holds inputs of shape {}, the model takes {} "
+                         "features".format(sample_path, inputs.shape,
+                                           model.input_dim))
+
+    if len(inputs) > n_samples:
+        rng = np.random.RandomState(seed)
+        inputs = inputs[np.sort(rng.choice(len(inputs), n_samples,
+                                           replace=False))]
+    return inputs.astype("float32")
+
+
+def sample_inputs(model, dwi_path, n_samples, seed=3):
+    """Model inputs [vin, d/dnorm, dnorm] at random non-zero voxels of the
+    DWI, with random unit incoming directions. Unlike shard_inputs, these
+    are not the directions the tracker sees."""
+    dwi, _ = load_volume(dwi_path, canonical=True)
+    gather = Neighborhood(dwi, get_blocksize(model, dwi.shape[-1]))
+
+    rng = np.random.RandomState(seed)
+    voxels = np.argwhere(gather.nonzero())
+    ijk = voxels[rng.randint(len(voxels), size=n_samples)]
+
+    vin = rng.randn(n_samples, 3)
+    vin /= np.linalg.norm(vin, axis=1, keepdims=True)
+
+    d, dnorm = gather.features(ijk)
+    return np.hstack([vin, d, dnorm]).astype("float32")
+
+
+def mean_direction(model, inputs):
+    outputs = model(inputs)
+    if isinstance(outputs, list):
+        outputs = outputs[0]
+    return getattr(outputs, "mean_direction", outputs)
+
+
+def report(model_path, inputs, variants, chunk=2**12):
+    """Mean angular error (degrees) of each weight variant against float32,
+    with its file size. The variants are computed in float32 after loading,
+    so they run as fast as float32 (see utils.numpy_model.dequantize)."""
+    outputs = "mu"
+    reference = load_numpy_model(model_path)
+    if "mu" not in [node["name"] for node in reference.nodes]:
+        outputs = "full"
+    reference = reference.select(outputs)
+
+    mu = np.vstack([mean_direction(reference, inputs[i:i + chunk])
+                    for i in range(0, len(inputs), chunk)]).astype("float64")
+
+    print("{:>8s} {:>9s} {:>9s} {:>9s} {:>9s}".format(
+        "weights", "size MB", "mean deg", "p95 deg", "max deg"))
+    for weights in variants:
+        model = load_numpy_model(model_path, outputs=outputs, weights=weights)
+
+        mu_q = np.vstack([mean_direction(model, inputs[i:i + chunk])
+                          for i in range(0, len(inputs), chunk)])
+
+        # atan2 stays accurate for small angles, unlike arccos of the dot
+        mu_q = mu_q.astype("float64")
+        error = np.degrees(np.arctan2(
+            np.linalg.norm(np.cross(mu, mu_q), axis=1),
+            np.sum(mu * mu_q, axis=1)))
+        size = os.path.getsize(numpy_model_path(model_path, weights)) / 2**20
+
+        print("{:>8s} {:9.1f} {:9.4f} {:9.4f} {:9.4f}".format(
+            weights, size, error.mean(), np.percentile(error, 95),
+            error.max()))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Quantize a trained Dense tracker for the NumPy engine, "
+        "and report the angular error of its mean direction against float32. "
+        "The variants only shrink the model files: they are converted back "
+        "to float32 at load, and track as fast as float32.")
+
+    parser.add_argument("model_path", help="Path to .h5 file", type=str)
+
+    parser.add_argument("sample_path", help="Path to a samples .npz of "
+        "generate_samples.py, whose inputs are used for the report. A .nii "
+        "DWI instead is sampled at random voxels with random incoming "
+        "directions, which tracking does not see.", type=str)
+
+    parser.add_argument("--weights", nargs="+", default=WEIGHTS,
+        choices=WEIGHTS, help="Variants to create and compare.")
+
+    parser.add_argument("--n_samples", type=int, default=2**15)
+
+    args = parser.parse_args()
+
+    reference = load_numpy_model(args.model_path)
+
+    if args.sample_path.endswith(".npz"):
+        inputs = shard_inputs(reference, args.sample_path, args.n_samples)
+    else:
+        inputs = sample_inputs(reference, args.sample_path, args.n_samples)
+
+    report(args.model_path, inputs, args.weights)
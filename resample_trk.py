@@ -75,6 +75,7 @@ def resample_tractogram(tractogram, npts, smoothing,
     
     n_fails = 0
     n_length = 0
+    kept = []
     for i, f in enumerate(streamlines):
 
         flen = np.linalg.norm(f[1:] - f[:-1], axis=1).sum()
@@ -91,6 +92,7 @@ def resample_tractogram(tractogram, npts, smoothing,
         position.append(r, cache_build=True)
         tangent.append(t, cache_build=True)
         rows += cnt
+        kept.append(i)
         
         print("Finished {:3.0f}%".format(100*(i+1)/len(streamlines)), end="\r")
     
@@ -117,9 +119,14 @@ def resample_tractogram(tractogram, npts, smoothing,
         **other_data
     )
 
+    # e.g. the seed ids of inference.py, for the fibers that were kept
+    data_per_streamline = {key: value[kept] for key, value
+                           in tractogram.data_per_streamline.items()}
+
     return Tractogram(
         streamlines=position,
         data_per_point=data_per_point,
+        data_per_streamline=data_per_streamline,
         affine_to_rasmm=np.eye(4) # Fiber coordinates are already in rasmm space!
     )
 
@@ -17,7 +17,8 @@ from nibabel.streamlines.tractogram import Tractogram
 from time import time
 from dipy.io.gradients import read_bvals_bvecs
 
-from utils.prediction import Prior, Terminator
+from utils.prediction import Prior, Terminator, Neighborhood
+from utils.cache import load_volume
 from utils.training import setup_env, maybe_get_a_gpu
 from utils._score import score_on_tm
 
@@ -36,11 +37,8 @@ def run_rf_inference(config=None, gpu_queue=None):
     print(
         "Loading DWI...")  ####################################################
 
-    dwi_img = nib.load(config['dwi_path'])
-    dwi_img = nib.funcs.as_closest_canonical(dwi_img)
-    dwi_aff = dwi_img.affine
+    dwi, dwi_aff = load_volume(config['dwi_path'], canonical=True)
     dwi_affi = np.linalg.inv(dwi_aff)
-    dwi = dwi_img.get_data()
 
     def xyz2ijk(coords, snap=False):
         ijk = (coords.T).copy()
@@ -83,8 +81,8 @@ def run_rf_inference(config=None, gpu_queue=None):
     input_shape = model.n_features_
     block_size = int(np.cbrt(input_shape / dwi.shape[-1]))
 
-    d = np.zeros([n_seeds, dwi.shape[-1] * block_size ** 3])
-    dnorm = np.zeros([n_seeds, 1])
+    neighborhood = Neighborhood(dwi, block_size)
+
     vout = np.zeros([n_seeds, 3])
     for i in range(config['max_steps']):
         t0 = time()
@@ -94,21 +92,12 @@ def run_rf_inference(config=None, gpu_queue=None):
 
         n_ongoing = len(ijk)
 
-        for ii, idx in enumerate(ijk):
-            d[ii] = dwi[
-                    idx[0] - (block_size // 2): idx[0] + (block_size // 2) + 1,
-                    idx[1] - (block_size // 2): idx[1] + (block_size // 2) + 1,
-                    idx[2] - (block_size // 2): idx[2] + (block_size // 2) + 1,
-                    :].flatten()  # returns copy
-            dnorm[ii] = np.linalg.norm(d[ii])
-            d[ii] /= dnorm[ii]
+        d, dnorm = neighborhood.features(ijk, eps=0)
 
         if i == 0:
-            inputs = np.hstack([prior(xyz[:, 0, :]),
-                                d[:n_ongoing], dnorm[:n_ongoing]])
+            inputs = np.hstack([prior(xyz[:, 0, :]), d, dnorm])
         else:
-            inputs = np.hstack([vout[:n_ongoing],
-                                d[:n_ongoing], dnorm[:n_ongoing]])
+            inputs = np.hstack([vout[:n_ongoing], d, dnorm])
 
         chunk = 2 ** 15  # 32768
         n_chunks = np.ceil(n_ongoing / chunk).astype(int)
@@ -0,0 +1,109 @@
+import os
+import json
+
+import numpy as np
+import nibabel as nib
+import yaml
+
+from nibabel.streamlines import Tractogram, TrkFile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SIZE = 16
+N_COEF = 6
+
+
+def make_subject(path, n_seeds=60, seed=1):
+    """Random DWI, prior and mask volumes, seeds and a NumPy Dense tracker."""
+    rng = np.random.RandomState(seed)
+    affine = np.diag([1.25, 1.25, 1.25, 1.0])
+    affine[:3, 3] = -10
+
+    mask = np.zeros([SIZE] * 3, dtype="float32")
+    mask[2:-2, 2:-2, 2:-2] = 1
+    volumes = {
+        "dwi": rng.rand(SIZE, SIZE, SIZE, N_COEF).astype("float32"),
+        "prior": rng.randn(SIZE, SIZE, SIZE, 3).astype("float32"),
+        "mask": mask,
+    }
+    for name, volume in volumes.items():
+        nib.save(nib.Nifti1Image(volume, affine),
+                 os.path.join(path, name + ".nii.gz"))
+
+    ijk = rng.uniform(4, SIZE - 5, size=(n_seeds, 3))
+    xyz = ijk.dot(affine[:3, :3].T) + affine[:3, 3]
+    header = {"voxel_sizes": (1.25,) * 3, "dimensions": (SIZE,) * 3,
+              "voxel_to_rasmm": affine, "voxel_order": "RAS"}
+    TrkFile(Tractogram([p[np.newaxis] for p in xyz],
+                       affine_to_rasmm=np.eye(4)),
+            header).save(os.path.join(path, "seeds.trk"))
+
+    # [vin, d/dnorm, dnorm] of a 3^3 neighborhood
+    input_dim = 3 + 27 * N_COEF + 1
+    graph = {
+        "name": "Detrack",
+        "input": "inputs",
+        "input_dim": input_dim,
+        "nodes": [
+            {"name": "hidden", "inputs": ["inputs"], "op": "dense",
+             "activation": "relu"},
+            {"name": "out", "inputs": ["hidden"], "op": "dense",
+             "activation": "linear"},
+            {"name": "mu", "inputs": ["out"], "op": "l2_normalize"},
+        ],
+        "outputs": ["mu"],
+    }
+    model_dir = os.path.join(path, "model")
+    os.makedirs(model_dir)
+    np.savez(os.path.join(model_dir, "final_model.npz"),
+             graph=json.dumps(graph),
+             **{"kernel:hidden": rng.randn(input_dim, 32).astype("float32"),
+                "bias:hidden": np.zeros(32, dtype="float32"),
+                "kernel:out": rng.randn(32, 3).astype("float32"),
+                "bias:out": np.zeros(3, dtype="float32")})
+    with open(os.path.join(model_dir, "config.yml"), "w") as file:
+        yaml.dump({"model_name": "Detrack"}, file)
+
+
+def run(path, n_workers):
+    import inference
+
+    config = {
+        "model_path": os.path.join(path, "model", "final_model.npz"),
+        "dwi_path": os.path.join(path, "dwi.nii.gz"),
+        "prior_path": os.path.join(path, "prior.nii.gz"),
+        "seed_path": os.path.join(path, "seeds.trk"),
+        "term_path": os.path.join(path, "mask.nii.gz"),
+        "thresh": 0.1,
+        "step_size": 0.5,
+        "max_steps": 100,
+        "predict_fn": "mean",
+        "engine": "numpy",
+        "n_workers": n_workers,
+        "max_active": 16,
+        "score": False,
+        "min_length": 0,
+        "max_length": 1000,
+        "python2": None,
+    }
+    fiber_path = inference.run_inference(config)
+    return nib.streamlines.load(fiber_path).tractogram.streamlines
+
+
+def test_sharded_tracking_matches_single_process(tmp_path, monkeypatch):
+    # run_inference records the commit of the working directory
+    monkeypatch.chdir(REPO)
+
+    fibers = []
+    for n_workers in [1, 2]:
+        path = str(tmp_path / "workers_{}".format(n_workers))
+        os.makedirs(path)
+        make_subject(path)
+        fibers.append(run(path, n_workers))
+
+    single, sharded = fibers
+    assert len(single) > 0
+    np.testing.assert_array_equal(single._lengths, sharded._lengths)
+    # The float32 BLAS result of a row can differ in the last bits with the
+    # number of rows in the batch, which differs between the shards
+    np.testing.assert_allclose(single.get_data(), sharded.get_data(),
+                               rtol=0, atol=1e-5)
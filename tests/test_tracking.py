@@ -0,0 +1,26 @@
+import numpy as np
+
+from utils.tracking import FiberStitcher
+
+
+def test_stitched_orientation_ignores_finish_order():
+    """The flipped half comes first, reversed, whichever half finishes
+    first."""
+    forward = np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0]], dtype="float64")
+    backward = np.array([[0, 0, 0], [-1, 0, 0]], dtype="float64")
+    expected = np.array([[-1, 0, 0], [0, 0, 0], [1, 0, 0], [2, 0, 0]])
+
+    for halves in [[(forward, False), (backward, True)],
+                   [(backward, True), (forward, False)]]:
+        stitcher = FiberStitcher(1)
+        for half, flip in halves:
+            stitcher.add(half, [len(half)], [0], [flip])
+        streamlines, _ = stitcher.pop([0])
+        np.testing.assert_array_equal(streamlines[0], expected)
+
+    # Both halves finishing in the same step
+    stitcher = FiberStitcher(1)
+    stitcher.add(np.vstack([forward, backward]), [3, 2], [0, 0],
+                 [False, True])
+    streamlines, _ = stitcher.pop([0])
+    np.testing.assert_array_equal(streamlines[0], expected)
@@ -0,0 +1,59 @@
+import os
+import json
+import argparse
+
+from glob import glob
+from pandas import DataFrame, option_context
+
+from utils.config import load
+
+SCORES = ['mean_F1', 'VC', 'IC', 'NC', 'VB', 'IB', 'mean_OL', 'mean_OR']
+
+
+def run_summary(out_dir):
+    """Model, throughput and Tractometer scores of an inference run."""
+    config = load(os.path.join(out_dir, "config.yml"))
+    tracking = config.get("tracking") or {}
+
+    summary = {
+        "run": os.path.basename(os.path.normpath(out_dir)),
+        "model": (config.get("training_config") or {}).get("model_name"),
+        "engine": config.get("engine", "keras"),
+        "weights": config.get("model_weights", "float32"),
+        "step_mode": config.get("step_mode", "fixed"),
+        "points/s": tracking.get("points_per_sec"),
+        "steps/fiber": tracking.get("steps_per_fiber"),
+    }
+
+    score_paths = glob(os.path.join(out_dir, "scorings", "scores", "*.json"))
+    if score_paths:
+        with open(score_paths[0]) as file:
+            scores = json.load(file)
+        summary.update((k, scores.get(k)) for k in SCORES)
+
+    return summary
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare the speed and "
+        "Tractometer scores of inference runs, e.g. of a teacher and its "
+        "distilled students, or of fixed and adaptive step sizes. Speedups "
+        "and step reductions are relative to the first run.")
+
+    parser.add_argument("out_dirs", nargs="+", type=str,
+        help="Output directories of inference.py, with scorings.")
+
+    args = parser.parse_args()
+
+    df = DataFrame([run_summary(out_dir) for out_dir in args.out_dirs])
+    if df["points/s"].notnull().all():
+        df["speedup"] = df["points/s"] / df["points/s"].iloc[0]
+    if df["steps/fiber"].notnull().all():
+        # Model evaluations per streamline, saved by adaptive steps or
+        # direction_lut
+        df["step reduction"] = (1 - df["steps/fiber"]
+                                / df["steps/fiber"].iloc[0])
+
+    with option_context("display.max_columns", None, "display.width", 200):
+        print(df)
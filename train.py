@@ -46,7 +46,7 @@ def train(config=None, gpu_queue=None):
             configs.deep_update(config,
                                 {"reset_batches": train_seq.reset_batches})
             configs.deep_update(config, {"filepath": checkpoints})
-        if 'Trackifier' in config['model_name']:
+        if 'Trackifier' in config['model_name'] or "teacher_path" in config:
             configs.deep_update(config, {"filepath": checkpoints})
 
         callbacks = parse_callbacks(config["callbacks"])
@@ -67,6 +67,9 @@ def train(config=None, gpu_queue=None):
                 os.path.dirname(config['train_path']), 'config.yml')
             samples_config = configs.load(samples_config)
             config['input_sampels_config'] = samples_config
+        if "teacher_path" in config:
+            config['teacher_config'] = configs.load(os.path.join(
+                os.path.dirname(config['teacher_path']), 'config.yml'))
         repo = git.Repo(".")
         commit = repo.head.commit
         config['commit'] = str(commit)
@@ -134,6 +137,9 @@ if __name__ == '__main__':
     parser.add_argument("--lr", type=float, dest="learning_rate",
                         help="Learning rate.")
 
+    parser.add_argument("--teacher", type=str, dest="teacher_path",
+        help="Path to a trained Entrack, distilled into an EntrackStudent.")
+
     args, more_args = parser.parse_known_args()
 
     config = configs.compile_from(args.config_path, args, more_args)
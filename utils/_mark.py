@@ -6,15 +6,15 @@ import numpy as np
 
 from time import time
 
-from tensorflow.keras.models import load_model
-
 from nibabel.streamlines.trk import TrkFile
 from nibabel.streamlines.tractogram import (Tractogram, PerArraySequenceDict)
 
 from resample_trk import maybe_add_tangent
-from models import MODELS
-from utils.training import setup_env, maybe_get_a_gpu, timestamp
-from utils.prediction import get_blocksize
+from utils.env import setup_env, maybe_get_a_gpu, timestamp
+from utils.numpy_model import load_numpy_model
+from utils.prediction import (Neighborhood, FeatureTable, get_blocksize,
+    to_grid)
+from utils.cache import cache_key, cache_dir_for, load_volume
 from utils.config import load
 
 import configs
@@ -31,11 +31,8 @@ def mark(config, gpu_queue=None):
         print(str(e))
     print("Loading DWI data ...")
 
-    dwi_img = nib.load(config["dwi_path"])
-    dwi_img = nib.funcs.as_closest_canonical(dwi_img)
-    dwi_aff = dwi_img.affine
+    dwi, dwi_aff = load_volume(config["dwi_path"], canonical=True)
     dwi_affi = np.linalg.inv(dwi_aff)
-    dwi = dwi_img.get_data()
 
     def xyz2ijk(coords, snap=False):
 
@@ -77,16 +74,44 @@ def mark(config, gpu_queue=None):
     print("Loading model ...")
     model_name = config['model_name']
 
-    if hasattr(MODELS[model_name], "custom_objects"):
-        model = load_model(config["model_path"],
-                           custom_objects=MODELS[model_name].custom_objects,
-                           compile=False)
+    if config.get("engine", "keras") == "numpy":
+        model = load_numpy_model(config["model_path"],
+                                 weights=config.get("model_weights", "float32"))
+    elif config.get("model_weights", "float32") != "float32":
+        raise ValueError("model_weights requires engine: numpy")
     else:
-        model = load_model(config["model_path"], compile=False)
+        from tensorflow.keras.models import load_model
+        from models import MODELS
+
+        if hasattr(MODELS[model_name], "custom_objects"):
+            model = load_model(config["model_path"],
+                               custom_objects=MODELS[model_name].custom_objects,
+                               compile=False)
+        else:
+            model = load_model(config["model_path"], compile=False)
 
     block_size = get_blocksize(model, dwi.shape[-1])
 
-    d = np.zeros([n_fibers, dwi.shape[-1] * block_size**3 + 1])
+    cache_dir = (config.get("cache_dir") or
+                 cache_dir_for(config["dwi_path"], "feature_tables"))
+
+    gather = Neighborhood(dwi, block_size, brick=config.get("brick_size"),
+                          cache_dir=cache_dir, key=cache_key(config["dwi_path"]))
+
+    if config.get("feature_table", False):
+        print("Loading feature table ...")
+        mask = None
+        if config.get("term_path") is not None:
+            # On the canonical DWI grid, like the features
+            term, term_aff = load_volume(config["term_path"])
+            mask = to_grid(term >= config["thresh"], np.linalg.inv(term_aff),
+                           dwi.shape, dwi_aff)
+        gather = FeatureTable(
+            gather,
+            mask=mask,
+            cache_dir=cache_dir,
+            key=cache_key(config["dwi_path"])
+        )
 
     inputs = np.zeros([
         n_fibers,
@@ -114,19 +139,7 @@ def mark(config, gpu_queue=None):
         xyz = inputs[:, step, :]
         ijk = xyz2ijk(xyz, snap=True)
 
-        for ii, idx in enumerate(ijk):
-            try:
-                d[ii, :-1] = dwi[
-                        idx[0]-(block_size // 2): idx[0]+(block_size // 2)+1,
-                        idx[1]-(block_size // 2): idx[1]+(block_size // 2)+1,
-                        idx[2]-(block_size // 2): idx[2]+(block_size // 2)+1,
-                        :].flatten()  # returns copy
-            except (IndexError, ValueError):
-                pass
-
-        d[:, -1] = np.linalg.norm(d[:, :-1], axis=1) + 10**-2
-
-        d[:, :-1] /= d[:, -1].reshape(-1, 1)
+        d, dnorm = gather.features(ijk)
 
         if step == 0:
             vin = - inputs[:, step+1, :]
@@ -135,7 +148,7 @@ def mark(config, gpu_queue=None):
             vin = inputs[:, step-1, :]
             vout = inputs[:, step, :]
 
-        model_inputs = np.hstack([vin, d])
+        model_inputs = np.hstack([vin, d, dnorm])
         chunk = 2**15  # 32768
         n_chunks = np.ceil(n_fibers / chunk).astype(int)
         for c in range(n_chunks):
@@ -0,0 +1,105 @@
+import os
+import hashlib
+
+import numpy as np
+import nibabel as nib
+
+
+def cache_dir_for(path, name):
+    """Default cache directory next to a data file, e.g. subjects/x/name/."""
+    return os.path.join(os.path.dirname(os.path.abspath(path)), name)
+
+
+def cache_key(*items):
+    """Short hash over files (path, size, mtime) and plain parameters."""
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = hashlib.sha1(np.ascontiguousarray(item).tobytes()).hexdigest()
+        elif isinstance(item, str) and os.path.isfile(item):
+            stat = os.stat(item)
+            item = (os.path.realpath(item), stat.st_size, stat.st_mtime_ns)
+        h.update(repr(item).encode())
+    return h.hexdigest()[:16]
+
+
+def cached_array(path, shape, dtype, fill):
+    """Memory-map the .npy file at path, creating it with fill(out) if needed.
+
+    The file is written under a temporary name and renamed when complete, so
+    concurrent runs never map a half-written table.
+    """
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype,
+                                        shape=tuple(shape))
+        fill(out)
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+def _save_atomic(path, arr):
+    tmp_path = "{}.{}.tmp.npy".format(path[:-len(".npy")], os.getpid())
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, path)
+
+
+def content_key(path, cache_dir):
+    """Short hash over the content of a file.
+
+    It is remembered in cache_dir per (path, size, mtime), such that a file
+    is only read once per version.
+    """
+    memo_path = os.path.join(cache_dir, "content_{}.txt".format(
+        cache_key(path)))
+    if os.path.exists(memo_path):
+        with open(memo_path) as file:
+            return file.read().strip()
+
+    h = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(2**24), b""):
+            h.update(chunk)
+    key = h.hexdigest()[:16]
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(memo_path, os.getpid())
+    with open(tmp_path, "w") as file:
+        file.write(key)
+    os.replace(tmp_path, memo_path)
+    return key
+
+
+def load_volume(path, canonical=False, dtype="float32", cache_dir=None):
+    """Return data and affine of a NIfTI volume, via an uncompressed cache.
+
+    The first load decompresses the file, optionally reorients it with
+    nib.funcs.as_closest_canonical, converts it to dtype (None keeps the
+    stored one) and saves it in cache_dir, by default next to the file.
+    Later loads, from any script or process, only memory-map the cached
+    copy, which is keyed by the file content. The data is read-only.
+    """
+    cache_dir = cache_dir or cache_dir_for(path, "volume_cache")
+    key = cache_key(content_key(path, cache_dir), canonical,
+                    None if dtype is None else np.dtype(dtype).str)
+    data_path = os.path.join(cache_dir, "volume_{}.npy".format(key))
+    affine_path = os.path.join(cache_dir, "volume_{}_affine.npy".format(key))
+
+    if not os.path.exists(data_path):
+        img = nib.load(path)
+        if canonical:
+            img = nib.funcs.as_closest_canonical(img)
+        # Saved before the data, whose presence marks a complete entry
+        _save_atomic(affine_path, img.affine)
+
+        data = np.asanyarray(img.dataobj)
+
+        def fill(out):
+            out[:] = data
+
+        cached_array(data_path, data.shape, dtype or data.dtype, fill)
+
+    return np.load(data_path, mmap_mode="r"), np.load(affine_path)
@@ -0,0 +1,52 @@
+import os
+import sys
+import logging
+import datetime
+
+import numpy as np
+
+from GPUtil import getFirstAvailable
+
+
+def setup_env(func):
+
+    def setup_env_and_run(*args, **kwargs):
+
+        os.environ['PYTHONHASHSEED'] = '0'
+        # TensorFlow is only seeded where it is used; the NumPy inference
+        # engine runs without importing it.
+        if "tensorflow" in sys.modules:
+            sys.modules["tensorflow"].compat.v1.set_random_seed(3)
+        np.random.seed(3)
+
+        os.environ['TF_CPP_MIN_LOG_LEVEL'] = "2"  # ERROR
+        logging.getLogger('tensorflow').setLevel(logging.ERROR)
+
+        return func(*args, **kwargs)
+
+    return setup_env_and_run
+
+
+def clear_session():
+    """K.clear_session(), if TensorFlow was imported."""
+    if "tensorflow" in sys.modules:
+        sys.modules["tensorflow"].keras.backend.clear_session()
+
+
+def maybe_get_a_gpu():
+    return str(getFirstAvailable(
+            order="random", maxLoad=10 ** -6, maxMemory=10 ** -1)[0])
+
+
+def timestamp(separate=False):
+    tstamp = datetime.datetime.now().strftime("%Y-%m-%d=%H:%M:%S")
+    if separate:
+        return tstamp.split("=")
+    else:
+        return tstamp
+
+
+def set_blas_threads(n):
+    """Limit the threads of the BLAS used by NumPy, e.g. per worker process."""
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=n, user_api="blas")
@@ -0,0 +1,303 @@
+import os
+import copy
+import json
+
+import numpy as np
+
+
+class FvMDistribution(object):
+    """NumPy counterpart of models.model_classes.FisherVonMises (d=3)."""
+
+    def __init__(self, mean_direction, concentration):
+        self.mean_direction = mean_direction
+        self._concentration = concentration
+
+    @property
+    def concentration(self):
+        return self._concentration
+
+    def _log_normalization(self):
+        kappa = self.concentration
+        return (np.log(2 * np.pi) + kappa + np.log1p(-np.exp(-2 * kappa))
+                - np.log(kappa))
+
+    def log_prob(self, x):
+        return (self.concentration * np.sum(x * self.mean_direction, axis=-1)
+                - self._log_normalization())
+
+
+class CategoricalDistribution(object):
+    """NumPy counterpart of models.model_classes.OneHotCategorical."""
+
+    def __init__(self, probs, bvecs):
+        self.probs = probs
+        self.bvecs = bvecs
+
+    def probs_parameter(self):
+        return self.probs
+
+    @property
+    def mean_direction(self):
+        vecs = self.probs.dot(self.bvecs)
+        return vecs / np.linalg.norm(vecs, axis=1, keepdims=True)
+
+
+def _activate(x, activation):
+    if activation == "relu":
+        np.maximum(x, 0, out=x)
+    elif activation == "sigmoid":
+        x[:] = 1 / (1 + np.exp(-x))
+    elif activation == "softmax":
+        x -= x.max(axis=1, keepdims=True)
+        np.exp(x, out=x)
+        x /= x.sum(axis=1, keepdims=True)
+    elif activation != "linear":
+        raise NotImplementedError(activation)
+    return x
+
+
+class NumpyModel(object):
+    """Executes a Dense tracker exported with export(), without TensorFlow.
+
+    Calling it returns the same outputs as the Keras model, with the
+    distributions replaced by FvMDistribution and CategoricalDistribution.
+    The matrix products run in float32 on the (multi-threaded) BLAS of NumPy.
+    """
+
+    def __init__(self, path):
+        with np.load(path) as f:
+            self.arrays = {k: f[k] for k in f.files if k != "graph"}
+            graph = json.loads(str(f["graph"]))
+        dequantize(self.arrays)
+        self.name = graph["name"]
+        self.input_name = graph["input"]
+        self.input_dim = graph["input_dim"]
+        self.set_graph(graph["nodes"], graph["outputs"])
+
+    def set_graph(self, nodes, outputs):
+        self.nodes = nodes
+        self.outputs = outputs
+
+        # Intermediate values are dropped after their last use
+        self.last_use = {}
+        for i, node in enumerate(self.nodes):
+            for name in node["inputs"]:
+                self.last_use[name] = i
+
+    def select(self, outputs="full"):
+        """Copy that only evaluates the nodes needed for outputs, see
+        models.surgery.inference_model."""
+        if outputs == "full":
+            return self
+
+        names = outputs.split("_")
+        producers = {node["name"]: node for node in self.nodes}
+        if not all(name in producers for name in names):
+            raise ValueError("{} has no outputs {}, choose from 'mu', "
+                             "'mu_kappa' or 'full'".format(self.name, outputs))
+
+        needed = set()
+        stack = list(names)
+        while stack:
+            name = stack.pop()
+            if name in needed or name not in producers:
+                continue
+            needed.add(name)
+            stack.extend(producers[name]["inputs"])
+
+        model = copy.copy(self)
+        model.name = "{}_{}".format(self.name, outputs)
+        model.set_graph([n for n in self.nodes if n["name"] in needed], names)
+        return model
+
+    def first_dense(self):
+        """The Dense node that consumes the model inputs."""
+        for node in self.nodes:
+            if node["op"] == "dense" and node["inputs"] == [self.input_name]:
+                return node
+        raise ValueError("{} does not start with a Dense layer".format(
+            self.name))
+
+    def run(self, values):
+        """Evaluate all nodes that are not given in values."""
+        for i, node in enumerate(self.nodes):
+            if node["name"] in values:
+                continue
+            x = [values[name] for name in node["inputs"]]
+            values[node["name"]] = self._evaluate(node, x)
+            for name in node["inputs"]:
+                if self.last_use[name] == i and name not in self.outputs:
+                    del values[name]
+
+        outputs = [values[name] for name in self.outputs]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def __call__(self, inputs):
+        return self.run({self.input_name: np.asarray(inputs, dtype="float32")})
+
+    def _evaluate(self, node, x):
+        op = node["op"]
+        if op == "dense":
+            h = x[0].dot(self.arrays["kernel:" + node["name"]])
+            h += self.arrays["bias:" + node["name"]]
+            return _activate(h, node["activation"])
+        elif op == "l2_normalize":
+            # Same epsilon as K.l2_normalize
+            norm = np.sqrt(np.maximum(np.sum(x[0]**2, axis=-1, keepdims=True),
+                                      1e-12))
+            return x[0] / norm
+        elif op == "kappa":
+            return x[0][:, 0] + 0.001
+        elif op == "fvm":
+            return FvMDistribution(x[0], x[1])
+        elif op == "categorical":
+            return CategoricalDistribution(x[0],
+                                           self.arrays["bvecs:" + node["name"]])
+        elif op == "identity":
+            return x[0]
+        raise NotImplementedError(op)
+
+
+class NumpyFirstLayerSplit(object):
+    """NumPy counterpart of models.surgery.FirstLayerSplit."""
+
+    def __init__(self, model, n_vin=3):
+        self.model = model
+        self.node = model.first_dense()
+        kernel = model.arrays["kernel:" + self.node["name"]]
+
+        self.kernel_vin = kernel[:n_vin]
+        self.kernel_voxel = kernel[n_vin:]
+        self.bias = model.arrays["bias:" + self.node["name"]]
+
+    def project(self, features):
+        return np.dot(features.astype("float32", copy=False),
+                      self.kernel_voxel)
+
+    def __call__(self, vin, projection):
+        h = projection + np.dot(vin.astype("float32", copy=False),
+                                self.kernel_vin)
+        h += self.bias
+        _activate(h, self.node["activation"])
+        return self.model.run({self.node["name"]: h})
+
+
+def export(model, path):
+    """Save the weights and graph of a Dense tracker Keras model to .npz."""
+    owner = {}
+    nodes = []
+    arrays = {}
+    input_name = None
+
+    for layer in model.layers:
+        owner[id(layer.output)] = layer.name
+        kind = type(layer).__name__
+        if kind == "InputLayer":
+            input_name = layer.name
+            continue
+
+        inputs = layer.input if isinstance(layer.input, (list, tuple)) \
+            else [layer.input]
+        node = {"name": layer.name, "inputs": [owner[id(t)] for t in inputs]}
+
+        if kind == "Dense":
+            kernel, bias = layer.get_weights()
+            node.update(op="dense", activation=layer.activation.__name__)
+            arrays["kernel:" + layer.name] = kernel.astype("float32")
+            arrays["bias:" + layer.name] = bias.astype("float32")
+        elif kind == "Dropout":
+            node.update(op="identity")
+        elif kind == "Lambda" and layer.name in ["mu", "kappa"]:
+            node.update(op="l2_normalize" if layer.name == "mu" else "kappa")
+        elif kind == "DistributionLambda" and layer.name == "fvm":
+            node.update(op="fvm")
+        elif kind == "DistributionLambda":
+            n_classes = inputs[0].shape[-1]
+            dist = layer(np.full([1, n_classes], 1 / n_classes, "float32"))
+            node.update(op="categorical")
+            arrays["bvecs:" + layer.name] = np.asarray(dist.bvecs, "float32")
+        else:
+            raise NotImplementedError("Layer {} of type {} can not be exported"
+                                      .format(layer.name, kind))
+        nodes.append(node)
+
+    graph = {
+        "name": model.name,
+        "input": input_name,
+        "input_dim": int(model.inputs[0].shape[-1]),
+        "nodes": nodes,
+        "outputs": [owner[id(model.get_layer(name).output)]
+                    for name in model.output_names],
+    }
+    np.savez(path, graph=json.dumps(graph), **arrays)
+
+
+def quantize(path, out_path, weights):
+    """Save the export at path with "int8" or "float16" kernels.
+
+    int8 kernels are scaled per output channel, such that the largest weight
+    of each channel maps to 127. Biases stay float32.
+    """
+    with np.load(path) as f:
+        arrays = {k: f[k] for k in f.files}
+
+    for key in [k for k in arrays if k.startswith("kernel:")]:
+        kernel = arrays[key]
+        if weights == "float16":
+            arrays[key] = kernel.astype("float16")
+        elif weights == "int8":
+            scale = np.abs(kernel).max(axis=0) / 127
+            scale[scale == 0] = 1
+            arrays[key] = np.round(kernel / scale).astype("int8")
+            arrays["scale:" + key.split(":", 1)[1]] = scale.astype("float32")
+        else:
+            raise ValueError("Unknown weights {}, choose from {}".format(
+                weights, WEIGHTS))
+    np.savez(out_path, **arrays)
+
+
+def dequantize(arrays):
+    """Convert quantized kernels in arrays back to float32, in place.
+
+    NumPy has no int8 or float16 matrix products, so quantized models are
+    computed in float32. Only the file and the load get smaller.
+    """
+    for key in [k for k in arrays if k.startswith("kernel:")]:
+        scale = arrays.pop("scale:" + key.split(":", 1)[1], None)
+        kernel = arrays[key].astype("float32")
+        if scale is not None:
+            kernel *= scale
+        arrays[key] = kernel
+
+
+WEIGHTS = ["float32", "float16", "int8"]
+
+
+def numpy_model_path(model_path, weights="float32"):
+    root = os.path.splitext(model_path)[0]
+    if weights == "float32":
+        return root + ".npz"
+    return "{}_{}.npz".format(root, weights)
+
+
+def load_numpy_model(model_path, outputs="full", weights="float32"):
+    """Load the NumPy export of the Keras model at model_path (.h5 or .npz).
+
+    A missing export of an .h5 model is created once, which is the only case
+    where TensorFlow is imported. Likewise, weights other than float32 are
+    quantized from the export once, see quantize.
+    """
+    path = numpy_model_path(model_path)
+    if not os.path.exists(path):
+        from models import load_model
+        print("Exporting {} to {}".format(model_path, path))
+        export(load_model(model_path), path)
+
+    if weights != "float32":
+        quantized_path = numpy_model_path(model_path, weights)
+        if not os.path.exists(quantized_path):
+            print("Quantizing {} to {}".format(path, quantized_path))
+            quantize(path, quantized_path, weights)
+        path = quantized_path
+
+    return NumpyModel(path).select(outputs)
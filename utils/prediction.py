@@ -1,12 +1,16 @@
+import os
+import threading
+
 import numpy as np
-import nibabel as nib
 from sklearn.preprocessing import normalize
 
+from utils.cache import cache_key, cached_array, load_volume
+
 class MarginHandler(object):
 
     def xyz2ijk(self, xyz):
-        ijk = (xyz.T).copy()
-        self.affi.dot(ijk, out=ijk)
+        # Accepts (n, 3) coordinates or (n, 4) with the affine dimension
+        ijk = self.affi[:3, :3].dot(xyz[:, :3].T) + self.affi[:3, 3:]
         return np.round(ijk, out=ijk).astype(int, copy=False)
 
 
@@ -14,18 +18,20 @@ class Prior(MarginHandler):
 
     def __init__(self, prior_path):
         if ".nii" in prior_path:
-            vec_img = nib.load(prior_path)
-            self.vec = vec_img.get_data()
-            self.affi = np.linalg.inv(vec_img.affine)
+            self.vec, affine = load_volume(prior_path)
+            self.affi = np.linalg.inv(affine)
         elif ".h5" in prior_path:
             raise NotImplementedError # TODO: Implement prior model
         
-    def __call__(self, xyz):
+    def __call__(self, xyz, flip=None):
         if hasattr(self, "vec"):
             ijk = self.xyz2ijk(xyz)
             vecs = self.vec[ijk[0], ijk[1], ijk[2]] # fancy indexing -> copy!
-            # Assuming that seeds have been duplicated for both directions!
-            vecs[len(vecs)//2:, :] *= -1
+            if flip is None:
+                # Assuming that seeds have been duplicated for both directions!
+                vecs[len(vecs)//2:, :] *= -1
+            else:
+                vecs[flip, :] *= -1
             return normalize(vecs)
         elif hasattr(self, "model"):
             raise NotImplementedError # TODO: Implement prior model
@@ -35,9 +41,8 @@ class Terminator(MarginHandler):
 
     def __init__(self, term_path, thresh):
         if ".nii" in term_path:
-            scalar_img = nib.load(term_path)
-            self.scalar = scalar_img.get_data()
-            self.affi = np.linalg.inv(scalar_img.affine)
+            self.scalar, affine = load_volume(term_path)
+            self.affi = np.linalg.inv(affine)
         elif ".h5" in term_path:
             raise NotImplementedError # TODO: Implement termination model
         self.threshold = thresh
@@ -51,8 +56,619 @@ class Terminator(MarginHandler):
             raise NotImplementedError
 
 
+def to_grid(volume, affi, shape, affine):
+    """Resample volume, whose voxel to world inverse affine is affi, to the
+    voxel grid of shape and affine (nearest neighbor, zero outside)."""
+    volume = np.asarray(volume)
+    shape = tuple(int(s) for s in shape[:3])
+    if volume.shape[:3] == shape and np.allclose(affi.dot(affine), np.eye(4)):
+        return volume
+
+    # Nearest voxel of the volume at each voxel center of the grid
+    ijk = np.indices(shape).reshape(3, -1)
+    xyz = affine[:3, :3].dot(ijk) + affine[:3, 3:]
+    src = np.round(affi[:3, :3].dot(xyz) + affi[:3, 3:]).astype(int)
+    inside = np.all((src >= 0) &
+                    (src < np.array(volume.shape[:3])[:, None]), axis=0)
+    out = np.zeros((len(inside),) + volume.shape[3:], dtype=volume.dtype)
+    out[inside] = volume[tuple(src[:, inside])]
+    return out.reshape(shape + volume.shape[3:])
+
+
+class VoxelGrid(object):
+    """The DWI voxel grid, with the termination mask and prior on it.
+
+    locate() transforms positions to DWI voxels once per step; the voxels
+    then index the mask, the prior and the features alike. Volumes on
+    another grid are resampled to the DWI grid (nearest neighbor) once.
+    Positions outside the volume are terminated, with a zero prior.
+    """
+
+    def __init__(self, shape, affine, terminator, prior):
+        self.shape = tuple(int(s) for s in shape[:3])
+        self.affine = affine
+        self.affi = np.linalg.inv(affine)
+
+        alive = terminator.scalar >= terminator.threshold
+        self.alive = to_grid(alive, terminator.affi, self.shape,
+                             affine).ravel()
+        self.prior = to_grid(prior.vec, prior.affi, self.shape,
+                             affine).reshape(-1, 3)
+
+    def locate(self, xyz):
+        """DWI voxels ijk (n, 3) of positions xyz, and their flat indices,
+        -1 outside the volume."""
+        ijk = self.affi[:3, :3].dot(xyz[:, :3].T) + self.affi[:3, 3:]
+        ijk = np.round(ijk, out=ijk).astype(int, copy=False).T
+        inside = np.all((ijk >= 0) & (ijk < self.shape), axis=1)
+        index = np.ravel_multi_index(ijk.T, self.shape, mode="clip")
+        index[~inside] = -1
+        return ijk, index
+
+    def terminated(self, index):
+        """Indices are terminated outside the volume and the mask."""
+        return (index < 0) | ~self.alive[index]
+
+    def prior_direction(self, index, flip):
+        vecs = self.prior[index]  # fancy indexing -> copy!
+        vecs[index < 0] = 0
+        vecs[flip] *= -1
+        return normalize(vecs)
+
+
+class Neighborhood(object):
+    """Gathers the block_size**3 neighborhood of many voxels at once.
+
+    The volume is zero-padded once by block_size//2, so every block is a fixed
+    set of flat row offsets from its corner voxel, and all blocks are fetched
+    with a single np.take into a reused buffer. Voxels outside the volume
+    yield zero blocks.
+
+    With brick, the rows are stored in brick**3 voxel tiles instead of C
+    order (see brick_layout), such that a block touches a few tiles instead
+    of block_size**2 distant rows. The bricked rows are cached in cache_dir.
+    """
+
+    def __init__(self, dwi, block_size, padded=False, brick=None,
+                 cache_dir=None, key=None):
+        self.block_size = block_size
+        self.n_coef = dwi.shape[-1]
+
+        m = block_size // 2
+        if padded:
+            # e.g. a memory-mapped volume from padded_volume
+            self.volume = dwi
+            self.shape = np.array(dwi.shape[:3]) - 2 * m
+        else:
+            self.volume = np.pad(dwi, [(m, m), (m, m), (m, m), (0, 0)],
+                                 mode="constant")
+            self.shape = np.array(dwi.shape[:3])
+        self.rows = self.volume.reshape(-1, self.n_coef)
+        self.padded_shape = self.volume.shape[:3]
+
+        o = np.arange(block_size)
+        oi, oj, ok = np.meshgrid(o, o, o, indexing="ij")
+        self.offsets = np.ravel_multi_index(
+            [oi.ravel(), oj.ravel(), ok.ravel()], self.padded_shape)
+
+        self.layout = None
+        if brick:
+            self.layout = brick_layout(self.padded_shape, brick)
+            shape = (self.layout.max() + 1, self.n_coef)
+            rows = self.rows
+
+            def fill(out):
+                out[:] = 0
+                out[self.layout] = rows
+
+            if cache_dir is None:
+                self.rows = np.empty(shape, dtype=rows.dtype)
+                fill(self.rows)
+            else:
+                name = "bricked_{}.npy".format(
+                    cache_key(key, block_size, brick))
+                self.rows = cached_array(os.path.join(cache_dir, name),
+                                         shape, rows.dtype, fill)
+            # Only the bricked copy is kept
+            self.volume = None
+
+        self.buffer = np.empty([0, block_size**3, self.n_coef],
+                               dtype=self.rows.dtype)
+
+    @property
+    def n_features(self):
+        return self.block_size**3 * self.n_coef
+
+    def inside(self, ijk):
+        return np.all((ijk[:, :3] >= 0) & (ijk[:, :3] < self.shape), axis=1)
+
+    def __call__(self, ijk):
+        """Return flattened blocks (n, block_size**3 * n_coef) around ijk.
+
+        The result is a view into the reused buffer, copy it if it has to
+        survive the next call.
+        """
+        n = len(ijk)
+        if len(self.buffer) < n:
+            self.buffer = np.empty([n, self.block_size**3, self.n_coef],
+                                   dtype=self.rows.dtype)
+        out = self.buffer[:n]
+
+        inside = self.inside(ijk)
+        # With padding m, the block corner has the same index as the center
+        corner = np.ravel_multi_index(
+            np.clip(ijk[:, :3], 0, self.shape - 1).T, self.padded_shape)
+        rows = corner[:, np.newaxis] + self.offsets
+        if self.layout is not None:
+            rows = self.layout.take(rows)
+        np.take(self.rows, rows, axis=0, out=out)
+        out[~inside] = 0
+
+        return out.reshape(n, self.n_features)
+
+    def features(self, ijk, eps=10**-2):
+        """Return normalized blocks and their norms, i.e. (d/dnorm, dnorm)."""
+        d = self(ijk)
+        dnorm = np.linalg.norm(d, axis=1, keepdims=True) + eps
+        d /= dnorm
+        return d, dnorm
+
+    def nonzero(self):
+        """Mask of the voxels with any non-zero coefficient."""
+        m = self.block_size // 2
+        X, Y, Z = self.shape
+        rows = np.arange(np.prod(self.padded_shape)).reshape(
+            self.padded_shape)[m:m+X, m:m+Y, m:m+Z].ravel()
+        if self.layout is not None:
+            rows = self.layout[rows]
+        return np.any(self.rows[rows] != 0, -1).reshape(X, Y, Z)
+
+
+def brick_layout(shape, brick=8):
+    """Row of each voxel of a volume of shape (X, Y, Z), flattened in C
+    order, when the volume is stored in brick**3 voxel tiles.
+
+    Tiles are in C order, and so are the voxels within a tile, with the
+    coefficients of a voxel in one row. Partial tiles at the upper borders
+    are padded, their unused rows are never gathered.
+    """
+    i, j, k = np.meshgrid(*[np.arange(n) for n in shape], indexing="ij")
+    n_tiles = -(-np.array(shape) // brick)
+    tile = np.ravel_multi_index([i // brick, j // brick, k // brick], n_tiles)
+    within = np.ravel_multi_index([i % brick, j % brick, k % brick],
+                                  (brick, brick, brick))
+    return (tile * brick**3 + within).astype("int32").ravel()
+
+
+def padded_volume(dwi, block_size, path):
+    """Zero-padded dwi for Neighborhood(..., padded=True), cached at path.
+
+    The returned volume is memory-mapped, so several processes can share it.
+    """
+    m = block_size // 2
+    X, Y, Z, n_coef = dwi.shape
+
+    def fill(out):
+        out[:] = 0
+        out[m:m+X, m:m+Y, m:m+Z] = dwi
+
+    return cached_array(path, (X + 2*m, Y + 2*m, Z + 2*m, n_coef), dwi.dtype,
+                        fill)
+
+
+class FeatureTable(object):
+    """Normalized features [d/dnorm, dnorm] of every voxel in a mask.
+
+    For snapped voxels the model features only depend on the voxel index, so
+    they are computed once per DWI and fetched with a single fancy index.
+    With a cache_dir, the float32 table is memory-mapped from disk and reused
+    by later runs on the same data. Voxels outside the mask fall back to the
+    neighborhood gather.
+    """
+
+    def __init__(self, neighborhood, mask=None, cache_dir=None, key=None,
+                 eps=10**-2, chunk=2**14):
+        self.neighborhood = neighborhood
+        self.eps = eps
+
+        X, Y, Z = neighborhood.shape
+        if mask is None:
+            mask = neighborhood.nonzero()
+        mask = np.asarray(mask) > 0
+        if mask.shape != (X, Y, Z):
+            raise ValueError("Mask of shape {} does not match the DWI of shape"
+                             " {}".format(mask.shape, (X, Y, Z)))
+
+        voxels = np.argwhere(mask)
+        self.index = np.full(mask.shape, -1, dtype="int32")
+        self.index[mask] = np.arange(len(voxels), dtype="int32")
+
+        shape = (len(voxels), neighborhood.n_features + 1)
+
+        def fill(out):
+            for c in range(0, len(voxels), chunk):
+                d, dnorm = neighborhood.features(voxels[c:c+chunk], eps)
+                out[c:c+chunk, :-1] = d
+                out[c:c+chunk, -1:] = dnorm
+
+        self.key = cache_key(key, neighborhood.block_size, eps, mask)
+        self.cache_dir = cache_dir
+
+        if cache_dir is None:
+            self.table = np.empty(shape, dtype="float32")
+            fill(self.table)
+        else:
+            self.table = cached_array(
+                os.path.join(cache_dir, "features_{}.npy".format(self.key)),
+                shape, "float32", fill)
+
+    def __len__(self):
+        return len(self.table)
+
+    def rows(self, ijk):
+        """Table row of each voxel, -1 for voxels outside the mask."""
+        inside = self.neighborhood.inside(ijk)
+        ijk = np.clip(ijk[:, :3], 0, self.neighborhood.shape - 1)
+        rows = self.index[ijk[:, 0], ijk[:, 1], ijk[:, 2]]
+        rows[~inside] = -1
+        return rows
+
+    def __call__(self, ijk):
+        """Return rows [d/dnorm, dnorm] of shape (n, n_features + 1)."""
+        rows = self.rows(ijk)
+        out = self.table[np.maximum(rows, 0)]
+        missing = rows < 0
+        if missing.any():
+            d, dnorm = self.neighborhood.features(ijk[missing], self.eps)
+            out[missing, :-1] = d
+            out[missing, -1:] = dnorm
+        return out
+
+    def features(self, ijk, eps=None):
+        """Same interface as Neighborhood.features, eps is fixed by the table."""
+        out = self(ijk)
+        return out[:, :-1], out[:, -1:]
+
+
+class ProjectionTable(object):
+    """Per-voxel first layer projections [d/dnorm, dnorm] · W_voxel.
+
+    Built from a FeatureTable and the voxel part of a split first Dense
+    kernel (see models.surgery.FirstLayerSplit), and cached next to the
+    feature table.
+    """
+
+    def __init__(self, features, project, key=None, chunk=2**12):
+        self.features = features
+        self.project = project
+
+        width = project(features.table[:1]).shape[-1]
+        shape = (len(features), width)
+
+        def fill(out):
+            for c in range(0, len(features), chunk):
+                out[c:c+chunk] = project(features.table[c:c+chunk])
+
+        if features.cache_dir is None:
+            self.table = np.empty(shape, dtype="float32")
+            fill(self.table)
+        else:
+            name = "projection_{}.npy".format(cache_key(features.key, key))
+            self.table = cached_array(os.path.join(features.cache_dir, name),
+                                      shape, "float32", fill)
+
+    def __call__(self, ijk):
+        rows = self.features.rows(ijk)
+        out = self.table[np.maximum(rows, 0)]
+        missing = rows < 0
+        if missing.any():
+            out[missing] = self.project(self.features(ijk[missing]))
+        return out
+
+
+class DirectionGrid(object):
+    """Octahedral grid of n x n cells over the unit sphere.
+
+    The sphere is mapped onto the octahedron |x| + |y| + |z| = 1, which is
+    unfolded onto the square [-1, 1]^2, and split into n x n cells of
+    about equal solid angle.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.n_bins = n * n
+        uv = (np.arange(n) + 0.5) / n * 2 - 1
+        u, v = np.meshgrid(uv, uv, indexing="ij")
+        self.centers = self.decode(np.stack([u.ravel(), v.ravel()], axis=1))
+
+    @staticmethod
+    def _sign(x):
+        return np.where(x < 0, -1.0, 1.0)
+
+    def encode(self, vectors):
+        """Square coordinates (n, 2) in [-1, 1] of directions (n, 3)."""
+        p = vectors / np.abs(vectors).sum(axis=1, keepdims=True)
+        u, v = p[:, 0], p[:, 1]
+        lower = p[:, 2] < 0
+        u, v = (np.where(lower, (1 - np.abs(v)) * self._sign(u), u),
+                np.where(lower, (1 - np.abs(u)) * self._sign(v), v))
+        return np.stack([u, v], axis=1)
+
+    def decode(self, uv):
+        u, v = uv[:, 0], uv[:, 1]
+        z = 1 - np.abs(u) - np.abs(v)
+        lower = z < 0
+        x = np.where(lower, (1 - np.abs(v)) * self._sign(u), u)
+        y = np.where(lower, (1 - np.abs(u)) * self._sign(v), v)
+        vectors = np.stack([x, y, z], axis=1)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def index(self, vectors):
+        """Cell index of each direction."""
+        ij = np.floor((self.encode(vectors) + 1) / 2 * self.n).astype(int)
+        np.clip(ij, 0, self.n - 1, out=ij)
+        return ij[:, 0] * self.n + ij[:, 1]
+
+
+class PredictionCache(object):
+    """Model outputs per (voxel, direction cell), in a fixed size hash table.
+
+    With snapped voxel features, the model output only depends on the voxel
+    and the incoming direction. Quantizing the latter with a DirectionGrid,
+    outputs computed for one fiber are reused by all fibers that pass the
+    same voxel from about the same direction. lookup() returns the cached
+    rows and the distinct missing (voxel, cell) pairs, which are evaluated
+    at the cell centers and passed to complete(). The table is cleared
+    when it is more than max_load full. Lookups and inserts may run on
+    different threads.
+    """
+
+    def __init__(self, shape, grid, width, capacity=2**22, max_load=0.7):
+        bits = int(np.ceil(np.log2(capacity)))
+        self.shape = shape
+        self.grid = grid
+        self.shift = np.uint64(64 - bits)
+        self.mask = 2**bits - 1
+        self.keys = np.full(2**bits, -1, dtype="int64")
+        self.values = np.zeros([2**bits, width], dtype="float32")
+        self.max_load = max_load
+        self.n_entries = 0
+        self.n_lookups = 0
+        self.n_hits = 0
+        self.lock = threading.Lock()
+
+    def _probe(self, keys):
+        """Slot of each key, or the empty slot at which its probe ends."""
+        with np.errstate(over="ignore"):
+            slots = (_splitmix64(keys.astype(np.uint64))
+                     >> self.shift).astype("int64")
+        todo = np.arange(len(keys))
+        while len(todo) > 0:
+            found = self.keys[slots[todo]]
+            done = (found == keys[todo]) | (found == -1)
+            todo = todo[~done]
+            slots[todo] = (slots[todo] + 1) & self.mask
+        return slots
+
+    def lookup(self, ijk, vin):
+        """Return (keys, values, missing, new_keys, inverse, ijk, vin).
+
+        values holds the cached rows, and missing marks the others. The
+        distinct missing keys are new_keys, with voxels ijk and cell centers
+        vin, and new_keys[inverse] are the keys of the missing rows.
+
+        Rows outside the volume are always missing, with negative keys of
+        their own. They are evaluated at their own vin and never cached,
+        since their zero features would alias the border voxels.
+        """
+        inside = np.all((ijk >= 0) & (ijk < np.array(self.shape)), axis=1)
+        voxels = np.ravel_multi_index(ijk.T, self.shape, mode="clip")
+        keys = voxels * self.grid.n_bins + self.grid.index(vin)
+        keys[~inside] = -2 - np.flatnonzero(~inside)
+
+        missing = ~inside
+        values = np.zeros([len(keys), self.values.shape[1]],
+                          dtype=self.values.dtype)
+        with self.lock:
+            slots = self._probe(keys[inside])
+            missing[inside] = self.keys[slots] != keys[inside]
+            values[inside] = self.values[slots]
+
+        new_keys, first, inverse = np.unique(
+            keys[missing], return_index=True, return_inverse=True)
+
+        self.n_lookups += len(keys)
+        self.n_hits += len(keys) - missing.sum()
+
+        centers = self.grid.centers[new_keys % self.grid.n_bins]
+        direct = new_keys < 0
+        centers[direct] = vin[missing][first[direct]]
+        return (keys, values, missing, new_keys, inverse,
+                ijk[missing][first], centers)
+
+    def complete(self, lookup, new_values):
+        """Insert the outputs of the new keys, and return all rows."""
+        keys, values, missing, new_keys, inverse = lookup[:5]
+        values[missing] = new_values[inverse]
+        cached = new_keys >= 0
+        self.insert(new_keys[cached], new_values[cached])
+        return values
+
+    def insert(self, keys, values):
+        """Insert distinct keys. More keys than max_load of the table are
+        inserted in chunks, each of which may clear the table."""
+        # The table always keeps an empty slot, at which probes end
+        limit = max(1, min(int(self.max_load * len(self.keys)),
+                           len(self.keys) - 1))
+        with self.lock:
+            for start in range(0, len(keys), limit):
+                self._insert(keys[start:start + limit],
+                             values[start:start + limit], limit)
+
+    def _insert(self, keys, values, limit):
+        if self.n_entries + len(keys) > limit:
+            self.keys[:] = -1
+            self.n_entries = 0
+
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            slots = self._probe(keys[pending])
+            # Keys that end at the same empty slot take turns
+            _, first = np.unique(slots, return_index=True)
+            slots, rows = slots[first], pending[first]
+            self.n_entries += np.count_nonzero(self.keys[slots] == -1)
+            self.values[slots] = values[rows]
+            self.keys[slots] = keys[rows]
+            pending = np.delete(pending, first)
+
+    def summary(self):
+        return "{:.1f}% hits of {} lookups, {} entries".format(
+            100 * self.n_hits / max(self.n_lookups, 1), self.n_lookups,
+            self.n_entries)
+
+
+def _splitmix64(x):
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def seeded_uniform(seed, keys, size=2):
+    """Counter-based uniform numbers in [0, 1), shape (n, size).
+
+    Row i only depends on seed and keys[k][i], e.g. (seed index, direction,
+    step), so results do not depend on batch composition or sharding.
+    """
+    with np.errstate(over="ignore"):
+        h = np.full(len(keys[0]), seed, dtype=np.uint64)
+        for key in keys:
+            h = _splitmix64(h ^ np.asarray(key).astype(np.uint64))
+        u = np.empty([len(h), size])
+        for j in range(size):
+            h = _splitmix64(h)
+            u[:, j] = (h >> np.uint64(11)) * 2.0**-53
+    return u
+
+
+def sample_fvm(mu, kappa, u):
+    """Sample Fisher-von Mises directions (d=3) from uniforms u of shape (n, 2)."""
+    kappa = np.asarray(kappa, dtype="float64").reshape(-1)
+    w = 1 + np.log(u[:, 0] + (1 - u[:, 0]) * np.exp(-2 * kappa)) / kappa
+    theta = 2 * np.pi * u[:, 1]
+
+    # Orthonormal basis (b1, b2) perpendicular to mu
+    a = np.zeros_like(mu)
+    use_x = np.abs(mu[:, 0]) < 0.9
+    a[use_x, 0] = 1
+    a[~use_x, 1] = 1
+    b1 = np.cross(mu, a)
+    b1 /= np.linalg.norm(b1, axis=1, keepdims=True)
+    b2 = np.cross(mu, b1)
+
+    v = np.cos(theta)[:, np.newaxis] * b1 + np.sin(theta)[:, np.newaxis] * b2
+    return (w[:, np.newaxis] * mu
+            + np.sqrt(np.maximum(1 - w**2, 0))[:, np.newaxis] * v)
+
+
+def to_numpy(x):
+    """Value of a TensorFlow tensor, or x itself if it is already an array."""
+    return x.numpy() if hasattr(x, "numpy") else np.asarray(x)
+
+
+def sample(dist, u, index=None):
+    """Sample directions from a predicted distribution with uniforms u.
+
+    With index, row i of u samples from row index[i] of dist, e.g. to draw
+    several directions from one prediction.
+    """
+    def take(x):
+        x = to_numpy(x)
+        return x if index is None else x[index]
+
+    if hasattr(dist, "concentration"):
+        return sample_fvm(take(dist.mean_direction),
+                          take(dist.concentration), u)
+    elif hasattr(dist, "bvecs"):
+        probs = take(dist.probs_parameter())
+        idx = (np.cumsum(probs, axis=1) < u[:, :1]).sum(axis=1)
+        return to_numpy(dist.bvecs)[np.minimum(idx, probs.shape[1] - 1)]
+    else:
+        raise NotImplementedError
+
+
+def concentration(outputs):
+    """Predicted kappa in the outputs of a model: the FvM distribution of
+    the full model, or the second output of a "mu_kappa" model."""
+    first = outputs[0] if isinstance(outputs, list) else outputs
+    if hasattr(first, "concentration"):
+        return to_numpy(first.concentration)
+    elif isinstance(outputs, list) and len(outputs) > 1:
+        return to_numpy(outputs[1])
+    raise ValueError("The model does not predict a concentration (kappa)")
+
+
+def limit_turn(vin, vout, max_angle):
+    """Rotate vout towards vin, such that no step turns by more than
+    max_angle (degrees). Exact reversals are left as they are."""
+    cos = np.sum(vin * vout, axis=1)
+    turn = np.arccos(np.clip(cos, -1, 1))
+    capped = turn > np.radians(max_angle)
+
+    # Unit vector perpendicular to vin, in the plane of vin and vout
+    w = vout[capped] - cos[capped, np.newaxis] * vin[capped]
+    norm = np.linalg.norm(w, axis=1, keepdims=True)
+    valid = norm[:, 0] > 1e-6
+    capped[capped] = valid
+
+    a = np.radians(max_angle)
+    vout = vout.copy()
+    vout[capped] = np.cos(a) * vin[capped] + np.sin(a) * (w / norm)[valid]
+    return vout
+
+
+class StepSize(object):
+    """Step lengths of the tracking loop, in mm.
+
+    "fixed" steps step_size. The adaptive modes step between step_size and
+    max_step_size: "kappa" linearly in the predicted concentration, up to
+    max_step_size at max_kappa, and "angle" linearly in the turn from vin
+    to vout, from max_step_size for straight steps to step_size at
+    max_angle (degrees).
+    """
+
+    def __init__(self, mode, step_size, max_step_size=None, max_kappa=100,
+                 max_angle=0):
+        if mode not in ["fixed", "kappa", "angle"]:
+            raise ValueError("Unknown step_mode {}, choose from 'fixed', "
+                             "'kappa' or 'angle'".format(mode))
+        if mode == "angle" and not max_angle > 0:
+            raise ValueError("step_mode: angle needs max_step_angle > 0")
+        self.mode = mode
+        self.min = step_size
+        self.max = max_step_size or step_size
+        self.max_kappa = max_kappa
+        self.max_angle = max_angle
+
+    def __call__(self, vin, vout, kappa=None):
+        """Step length of each fiber, shape (n, 1), or a scalar for fixed."""
+        if self.mode == "fixed":
+            return self.min
+        elif self.mode == "kappa":
+            confidence = np.minimum(kappa / self.max_kappa, 1)
+        else:
+            cos = np.clip(np.sum(vin * vout, axis=1), -1, 1)
+            turn = np.degrees(np.arccos(cos))
+            confidence = 1 - np.minimum(turn / self.max_angle, 1)
+        step = self.min + (self.max - self.min) * confidence
+        return step[:, np.newaxis].astype(vout.dtype, copy=False)
+
+
 def get_blocksize(model, n_dwi_coef):
-    input_shape = model.layers[0].get_output_at(0).get_shape().as_list()[-1]
+    if hasattr(model, "input_dim"):
+        input_shape = model.input_dim
+    else:
+        input_shape = model.layers[0].get_output_at(0).get_shape().as_list()[-1]
 
     nvox = float((input_shape - 3 - 1) / n_dwi_coef)
 
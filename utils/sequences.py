@@ -5,6 +5,8 @@ import numpy as np
 from tensorflow.keras.utils import Sequence
 from tensorflow.keras.utils import to_categorical
 
+from utils.numpy_model import load_numpy_model
+
 
 class Samples(Sequence):
     def __init__(self, config):
@@ -165,6 +167,26 @@ class EntrackSamples(FvMSamples):
         return inputs, {"fvm": outgoing, "kappa": np.zeros(len(outgoing))}
 
 
+class DistillSamples(FvMSamples):
+    """Samples with the mu and kappa of config["teacher_path"] as targets.
+
+    The teacher runs on the NumPy engine, which is safe in the forked
+    workers of fit_generator.
+    """
+
+    def __init__(self, config):
+        super(DistillSamples, self).__init__(config)
+        self.teacher = load_numpy_model(config["teacher_path"],
+                                        outputs="mu_kappa")
+
+    def __getitem__(self, idx):
+        inputs, _ = super(DistillSamples, self).__getitem__(idx)
+        mu, kappa = self.teacher(inputs)
+
+        return inputs, {"fvm": np.hstack([mu, kappa[:, np.newaxis]]),
+                        "kappa": kappa}
+
+
 class RNNSamples(Samples):
 
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,514 @@
+import os
+import threading
+import numpy as np
+
+from time import time
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from nibabel.streamlines.array_sequence import ArraySequence
+
+
+class TrajectoryBuffer(object):
+    """Preallocated point storage for fibers that are still being tracked.
+
+    Each row holds one fiber, and cursor[i] is the number of points written to
+    row i. Capacity grows geometrically, so appending a step never copies the
+    fiber history, and removing fibers only moves the rows that fill the holes.
+    """
+
+    def __init__(self, start, capacity=64, dtype="float64"):
+        start = np.asarray(start)[:, :3]
+        self.n = len(start)
+        self.points = np.empty([self.n, max(capacity, 2), 3], dtype=dtype)
+        self.points[:, 0, :] = start
+        self.cursor = np.ones(self.n, dtype="int64")
+
+    def __len__(self):
+        return self.n
+
+    @classmethod
+    def from_flat(cls, data, lengths, capacity=64, dtype="float64"):
+        """Buffer holding fibers given as flat data and lengths."""
+        lengths = np.asarray(lengths, dtype="int64")
+        buffer = cls(np.zeros([0, 3]), capacity=capacity, dtype=dtype)
+        if len(lengths) > 0:
+            buffer._grow(len(lengths), lengths.max() + 1)
+            rows = np.repeat(np.arange(len(lengths)), lengths)
+            buffer.points[rows, segment_ranges(np.zeros_like(lengths),
+                                               lengths)] = data
+            buffer.cursor[:len(lengths)] = lengths
+            buffer.n = len(lengths)
+        return buffer
+
+    @property
+    def capacity(self):
+        return self.points.shape[1]
+
+    def _grow(self, min_rows, min_capacity):
+        rows, capacity = self.points.shape[:2]
+        while rows < min_rows:
+            rows = max(2 * rows, 1)
+        while capacity < min_capacity:
+            capacity *= 2
+        points = np.empty([rows, capacity, 3], dtype=self.points.dtype)
+        points[:self.n, :self.capacity] = self.points[:self.n]
+        self.points = points
+        cursor = np.ones(rows, dtype=self.cursor.dtype)
+        cursor[:self.n] = self.cursor[:self.n]
+        self.cursor = cursor
+
+    def last(self):
+        """Latest point of each fiber, shape (n, 3)."""
+        return self.points[np.arange(self.n), self.cursor[:self.n] - 1]
+
+    def first(self):
+        """Seed point of each fiber, shape (n, 3)."""
+        return self.points[:self.n, 0]
+
+    def add(self, start):
+        """Start new fibers at the end of the buffer, e.g. in freed slots."""
+        n_new = len(start)
+        if self.n + n_new > self.points.shape[0]:
+            self._grow(self.n + n_new, self.capacity)
+        self.points[self.n:self.n + n_new, 0] = np.asarray(start)[:, :3]
+        self.cursor[self.n:self.n + n_new] = 1
+        self.n += n_new
+
+    def append(self, rout):
+        """Write one new point per fiber in place."""
+        if self.n > 0 and self.cursor[:self.n].max() >= self.capacity:
+            self._grow(self.n, self.cursor[:self.n].max() + 1)
+        cursor = self.cursor[:self.n]
+        self.points[np.arange(self.n), cursor] = rout
+        cursor += 1
+
+    def get(self, indices):
+        """Return the points of the selected fibers as flat data and lengths."""
+        lengths = self.cursor[indices]
+        if len(indices) == 0:
+            return np.zeros([0, 3], dtype=self.points.dtype), lengths
+        rows = self.points[indices, :lengths.max()]
+        filled = np.arange(rows.shape[1]) < lengths[:, np.newaxis]
+        return rows[filled], lengths
+
+    def permute(self, perm):
+        """Reorder the fibers, such that fiber i is the former fiber perm[i]."""
+        self.points[:self.n] = self.points[perm]
+        self.cursor[:self.n] = self.cursor[perm]
+
+    def remove(self, indices):
+        """Drop fibers by swap-remove and return the applied move (dst, src).
+
+        Holes below the new length are filled with surviving rows from the
+        tail. Apply the same move to any other per-fiber arrays with:
+            arr[dst] = arr[src]; arr = arr[:len(self)]
+        """
+        dst, src = swap_remove_moves(self.n, indices)
+        self.points[dst] = self.points[src]
+        self.cursor[dst] = self.cursor[src]
+        self.n -= len(np.unique(indices))
+        return dst, src
+
+
+class SeedQueue(object):
+    """Hands out the two tracking directions of every seed, in order.
+
+    Entry 2*s is seed s along the prior, entry 2*s+1 the flipped direction,
+    so both halves of a fiber are tracked at about the same time. Used to
+    refill the slots of terminated fibers, such that the number of active
+    fibers stays close to a fixed budget.
+    """
+
+    def __init__(self, n_seeds, order=None):
+        self.order = np.arange(n_seeds) if order is None else np.asarray(order)
+        self.n_taken = 0
+
+    def __len__(self):
+        return 2 * len(self.order) - self.n_taken
+
+    def take(self, n):
+        """Return seed indices and flip flags of the next n entries."""
+        n = int(max(0, min(n, len(self))))
+        entries = np.arange(self.n_taken, self.n_taken + n)
+        self.n_taken += n
+        return self.order[entries // 2].astype("int32"), entries % 2 == 1
+
+
+def _spread_bits(x):
+    """Insert two zero bits after each of the lower 21 bits of x."""
+    x = x.astype("uint64") & np.uint64(0x1fffff)
+    for shift, mask in [(32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff),
+                        (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3),
+                        (2, 0x1249249249249249)]:
+        x = (x | x << np.uint64(shift)) & np.uint64(mask)
+    return x
+
+
+def morton_order(ijk):
+    """Permutation that sorts voxel coordinates (n, 3) along a Z-order curve,
+    such that nearby positions end up close to each other."""
+    ijk = np.maximum(ijk, 0)
+    codes = (_spread_bits(ijk[:, 0]) | _spread_bits(ijk[:, 1]) << np.uint64(1)
+             | _spread_bits(ijk[:, 2]) << np.uint64(2))
+    return np.argsort(codes, kind="stable")
+
+
+def revisited(visited, voxel, new_voxel):
+    """Which fibers entered a voxel that they visited before, i.e. loop.
+
+    visited holds the voxel indices seen by each fiber in a small hash of
+    shape (n, n_slots), -1 where empty, and voxel the current voxel of each
+    fiber. Both are updated in place with new_voxel. Voxels that collide in
+    the hash overwrite each other, so some loops are missed, but a fiber is
+    never reported for a voxel it did not visit.
+    """
+    rows = np.flatnonzero(new_voxel != voxel)
+    keys = new_voxel[rows]
+    slots = (keys * 2654435761) % visited.shape[1]
+
+    looped = np.zeros(len(voxel), dtype=bool)
+    looped[rows] = visited[rows, slots] == keys
+    visited[rows, slots] = keys
+    voxel[rows] = keys
+    return looped
+
+
+def swap_remove_moves(n, indices):
+    """Row moves that compact an array of length n after removing indices."""
+    removed = np.zeros(n, dtype=bool)
+    removed[indices] = True
+    n_keep = n - removed.sum()
+    dst = np.flatnonzero(removed[:n_keep])
+    src = n_keep + np.flatnonzero(~removed[n_keep:])
+    return dst, src
+
+
+class StreamlineBuffer(object):
+    """Flat, geometrically growing streamline storage.
+
+    The layout (data, offsets, lengths) is the one used by nibabel's
+    ArraySequence, so the buffer can be handed over without copying.
+    """
+
+    def __init__(self, capacity=2**16, dtype="float64"):
+        self._data = np.empty([capacity, 3], dtype=dtype)
+        self._offsets = np.empty(1024, dtype="int64")
+        self._lengths = np.empty(1024, dtype="int64")
+        self._ids = np.empty(1024, dtype="int64")
+        self.n_rows = 0
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    @staticmethod
+    def _resized(arr, size):
+        new_size = max(len(arr), 1)
+        while new_size < size:
+            new_size *= 2
+        if new_size == len(arr):
+            return arr
+        out = np.empty((new_size, ) + arr.shape[1:], dtype=arr.dtype)
+        out[:len(arr)] = arr
+        return out
+
+    def extend(self, data, lengths, ids):
+        """Append streamlines given as flat data with their lengths."""
+        n_new = len(lengths)
+        if n_new == 0:
+            return np.zeros(0, dtype="int64")
+        n_rows = self.n_rows + len(data)
+        self._data = self._resized(self._data, n_rows)
+        self._offsets = self._resized(self._offsets, self.n + n_new)
+        self._lengths = self._resized(self._lengths, self.n + n_new)
+        self._ids = self._resized(self._ids, self.n + n_new)
+
+        self._data[self.n_rows:n_rows] = data
+        offsets = self.n_rows + np.cumsum(lengths) - lengths
+        rows = np.arange(self.n, self.n + n_new)
+        self._offsets[rows] = offsets
+        self._lengths[rows] = lengths
+        self._ids[rows] = ids
+        self.n_rows = n_rows
+        self.n += n_new
+        return rows
+
+    def append(self, streamline, id):
+        return self.extend(streamline, [len(streamline)], [id])[0]
+
+    def __getitem__(self, row):
+        start = self._offsets[row]
+        return self._data[start:start + self._lengths[row]]
+
+    @property
+    def data(self):
+        return self._data[:self.n_rows]
+
+    @property
+    def lengths(self):
+        return self._lengths[:self.n]
+
+    @property
+    def ids(self):
+        return self._ids[:self.n]
+
+    def select(self, rows):
+        """New buffer holding only the given rows, in that order."""
+        rows = np.asarray(rows, dtype="int64")
+        out = StreamlineBuffer(capacity=max(self.n_rows, 1),
+                               dtype=self._data.dtype)
+        out.extend(self.to_array_sequence(order=rows)._data,
+                   self._lengths[rows], self._ids[rows])
+        return out
+
+    def to_array_sequence(self, order=None):
+        """Return an ArraySequence, optionally reordered, e.g. by seed id."""
+        seq = ArraySequence()
+        offsets = self._offsets[:self.n]
+        lengths = self._lengths[:self.n]
+        if order is None:
+            seq._data = self._data[:self.n_rows]
+            seq._offsets = offsets.copy()
+            seq._lengths = lengths.copy()
+        else:
+            order = np.asarray(order, dtype="int64")
+            lengths = lengths[order]
+            seq._data = self._data[segment_ranges(offsets[order], lengths)]
+            seq._offsets = np.cumsum(lengths) - lengths
+            seq._lengths = lengths
+        return seq
+
+
+def segment_ranges(starts, lengths, step=1):
+    """Concatenated index ranges start, start + step, ... of given lengths."""
+    lengths = np.asarray(lengths, dtype="int64")
+    within = (np.arange(lengths.sum())
+              - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    return np.repeat(np.asarray(starts, dtype="int64"), lengths) + step * within
+
+
+class FiberStitcher(object):
+    """Pairs the two halves of fibers tracked from a seed in both directions.
+
+    Both halves start at the seed point. The first finished half of seed s is
+    kept in halves, at row half_row[s], until the other one finishes, then
+    both are stitched into one fiber in fibers: the flipped half reversed,
+    then the other one, whichever finished first. Seeds with a failed half,
+    e.g. one that exceeded max_steps, never produce a fiber.
+    """
+
+    def __init__(self, n_seeds, dtype="float64"):
+        self.halves = StreamlineBuffer(dtype=dtype)
+        self.half_row = np.full(n_seeds, -1, dtype="int64")
+        self.failed = np.zeros(n_seeds, dtype=bool)
+        self.fibers = StreamlineBuffer(dtype=dtype)
+        self.fiber_row = np.full(n_seeds, -1, dtype="int64")
+        # Seeds that will not change anymore, stitched or failed
+        self.done = np.zeros(n_seeds, dtype=bool)
+
+    def state(self):
+        """Arrays that fully describe the stitcher, see load_state."""
+        return dict(
+            halves_data=self.halves.data, halves_lengths=self.halves.lengths,
+            halves_ids=self.halves.ids, fibers_data=self.fibers.data,
+            fibers_lengths=self.fibers.lengths, fibers_ids=self.fibers.ids,
+            failed=self.failed, done=self.done)
+
+    def load_state(self, state):
+        self.failed[:] = state["failed"]
+        self.done[:] = state["done"]
+        for name in ["halves", "fibers"]:
+            buffer = StreamlineBuffer(dtype=self.fibers._data.dtype)
+            buffer.extend(state[name + "_data"], state[name + "_lengths"],
+                          state[name + "_ids"])
+            setattr(self, name, buffer)
+        self.half_row[self.halves.ids] = np.arange(len(self.halves))
+        self.fiber_row[self.fibers.ids] = np.arange(len(self.fibers))
+
+    def fail(self, seeds):
+        self.failed[seeds] = True
+        self.done[seeds] = True
+
+    def pop(self, seeds):
+        """Remove the fibers of seeds that are done, and return them as an
+        ArraySequence in the order of seeds, with their seed ids.
+
+        Halves that are no longer needed are dropped as well, so that memory
+        stays bounded by the fibers which are still being tracked.
+        """
+        rows = self.fiber_row[seeds]
+        rows = rows[rows >= 0]
+        streamlines = self.fibers.to_array_sequence(order=rows)
+        ids = self.fibers.ids[rows]
+
+        keep = np.ones(len(self.fibers), dtype=bool)
+        keep[rows] = False
+        self.fibers = self.fibers.select(np.flatnonzero(keep))
+        self.fiber_row[ids] = -1
+        self.fiber_row[self.fibers.ids] = np.arange(len(self.fibers))
+
+        live = ~self.done[self.halves.ids]
+        if live.sum() < len(self.halves) // 2:
+            self.half_row[self.halves.ids[~live]] = -1
+            self.halves = self.halves.select(np.flatnonzero(live))
+            self.half_row[self.halves.ids] = np.arange(len(self.halves))
+
+        return streamlines, ids
+
+    def add(self, data, lengths, seeds, flip):
+        """Add finished halves of seeds, given as flat data and lengths, with
+        whether they were tracked in the flipped direction."""
+        seeds = np.asarray(seeds, dtype="int64")
+        lengths = np.asarray(lengths, dtype="int64")
+        flip = np.asarray(flip, dtype=bool)
+        starts = np.cumsum(lengths) - lengths
+
+        # Both halves of a seed may finish at once, the second one is added
+        # after the first
+        order = np.argsort(seeds, kind="stable")
+        second = np.zeros(len(seeds), dtype=bool)
+        second[order[1:]] = seeds[order[1:]] == seeds[order[:-1]]
+
+        for part in [~second, second]:
+            part &= ~self.failed[seeds]
+            first = part & (self.half_row[seeds] < 0)
+            self.half_row[seeds[first]] = self.halves.extend(
+                data[segment_ranges(starts[first], lengths[first])],
+                lengths[first], seeds[first])
+            part &= ~first
+            # The orientation of a fiber does not depend on which half
+            # finished first, which varies with the batch layout
+            for reverse_this in [True, False]:
+                rows = part & (flip == reverse_this)
+                self._stitch(data, starts[rows], lengths[rows], seeds[rows],
+                             reverse_this)
+
+    def _stitch(self, data, starts, lengths, seeds, reverse_this):
+        if len(seeds) == 0:
+            return
+        other = self.half_row[seeds]
+        other_data = self.halves._data
+        other_starts = self.halves._offsets[other]
+        other_lengths = self.halves._lengths[other]
+
+        # The flipped half reversed and without the seed point, then the
+        # other half
+        if reverse_this:
+            head = (data, starts, lengths)
+            tail = (other_data, other_starts, other_lengths)
+        else:
+            head = (other_data, other_starts, other_lengths)
+            tail = (data, starts, lengths)
+        n_flipped = head[2] - 1
+        merged = n_flipped + tail[2]
+        merged_starts = np.cumsum(merged) - merged
+        out = np.empty([merged.sum(), 3], dtype=self.fibers._data.dtype)
+        out[segment_ranges(merged_starts, n_flipped)] = head[0][
+            segment_ranges(head[1] + head[2] - 1, n_flipped, step=-1)]
+        out[segment_ranges(merged_starts + n_flipped, tail[2])] = \
+            tail[0][segment_ranges(tail[1], tail[2])]
+
+        self.fiber_row[seeds] = self.fibers.extend(out, merged, seeds)
+        self.done[seeds] = True
+
+
+class Checkpoint(object):
+    """Tracking state, saved to one .npz file at most every `every` seconds.
+
+    Along with the state, the size of the output written by writer is saved,
+    such that load() can cut off anything written after the checkpoint. The
+    file is written under a temporary name and renamed, so a run killed while
+    saving keeps its previous checkpoint.
+    """
+
+    def __init__(self, path, writer=None, every=300):
+        self.path = path
+        self.writer = writer
+        self.every = every
+        self.last = time()
+
+    def due(self):
+        return time() - self.last >= self.every
+
+    def save(self, **state):
+        if self.writer is not None:
+            state.update(n_written=self.writer.n_written,
+                         n_bytes=self.writer.tell())
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, **state)
+        os.replace(tmp_path, self.path)
+        self.last = time()
+
+    def load(self):
+        """Return the saved state, or None if there is no checkpoint."""
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as f:
+            state = dict(f)
+        if self.writer is not None:
+            self.writer.resume(int(state["n_written"]), int(state["n_bytes"]))
+        return state
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class StageTimer(object):
+    """Accumulates the time spent per stage, also from worker threads."""
+
+    def __init__(self):
+        self.totals = OrderedDict()
+        self.lock = threading.Lock()
+        self.start = time()
+
+    @contextmanager
+    def __call__(self, stage):
+        t0 = time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.totals[stage] = self.totals.get(stage, 0) + time() - t0
+
+    def summary(self):
+        wall = time() - self.start
+        busy = sum(self.totals.values())
+        return ", ".join(
+            ["{} {:.1f}s".format(k, v) for k, v in self.totals.items()] +
+            ["wall {:.1f}s, overlap {:.2f}x".format(wall, busy / wall)])
+
+
+def pipeline(n_groups, prepare, run, finish, executor=None, timer=None,
+             stages=("gather", "model", "terminate")):
+    """Run finish(g, run(g, prepare(g))) for all groups g, and return the
+    results of finish in order.
+
+    With an executor, prepare(g+1) and finish(g-1) run on its threads while
+    run(g) runs in the calling thread, e.g. a model forward pass that
+    releases the GIL. Only one prepare runs at a time.
+    """
+    timer = timer or StageTimer()
+
+    def timed(stage, fn):
+        def call(*args):
+            with timer(stage):
+                return fn(*args)
+        return call
+
+    prepare, run, finish = [timed(stage, fn) for stage, fn in
+                            zip(stages, [prepare, run, finish])]
+
+    if executor is None:
+        return [finish(g, run(g, prepare(g))) for g in range(n_groups)]
+
+    finished = []
+    prepared = executor.submit(prepare, 0)
+    for g in range(n_groups):
+        inputs = prepared.result()
+        if g + 1 < n_groups:
+            prepared = executor.submit(prepare, g + 1)
+        finished.append(executor.submit(finish, g, run(g, inputs)))
+
+    return [f.result() for f in finished]
@@ -1,17 +1,16 @@
 import os
-import logging
-import datetime
 
 import tensorflow as tf
 import numpy as np
 
-from GPUtil import getFirstAvailable, getAvailable
+from GPUtil import getAvailable
 
 from tensorflow.python.ops.resource_variable_ops import ResourceVariable
 from tensorflow.keras import backend as K
 
 from multiprocessing import SimpleQueue
 
+from utils.env import setup_env, maybe_get_a_gpu, timestamp
 from utils import summaries as tracking_summaries
 from utils import callbacks as tracking_callbacks
 from tensorflow.python.keras import callbacks as keras_callbacks
@@ -26,34 +25,6 @@ class Temperature(ResourceVariable):
         return {"T": float(K.get_value(self))}
 
 
-def setup_env(func):
-
-    def setup_env_and_run(*args, **kwargs):
-
-        os.environ['PYTHONHASHSEED'] = '0'
-        tf.compat.v1.set_random_seed(3)
-        np.random.seed(3)
-
-        os.environ['TF_CPP_MIN_LOG_LEVEL'] = "2"  # ERROR
-        logging.getLogger('tensorflow').setLevel(logging.ERROR)
-
-        return func(*args, **kwargs)
-
-    return setup_env_and_run
-
-
-def maybe_get_a_gpu():
-    return str(getFirstAvailable(
-            order="random", maxLoad=10 ** -6, maxMemory=10 ** -1)[0])
-
-
-def timestamp(separate=False):
-    tstamp = datetime.datetime.now().strftime("%Y-%m-%d=%H:%M:%S")
-    if separate:
-        return tstamp.split("=")
-    else:
-        return tstamp
-
 def parse_callbacks(config):
     callbacks = []
 
@@ -0,0 +1,80 @@
+import os
+import io
+
+import numpy as np
+
+from nibabel.streamlines.trk import TrkFile, header_2_dtype
+from nibabel.streamlines.tractogram import Tractogram
+
+
+class TrkStreamWriter(object):
+    """Appends tractograms to one .trk file, batch by batch.
+
+    Each batch is encoded by nibabel's TrkFile, and its streamline records are
+    appended to the file. The streamline count in the header is patched after
+    every batch, so the file is a valid tractogram at any time, e.g. to look
+    at the partial result of a long run. All batches need the same per point
+    and per streamline data.
+    """
+
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.n_written = 0
+        self.file = None
+        self.closed = False
+
+    def write(self, tractogram):
+        if len(tractogram) == 0:
+            return
+
+        buffer = io.BytesIO()
+        TrkFile(tractogram, self.header).save(buffer)
+        encoded = buffer.getvalue()
+
+        if self.file is None:
+            self.file = open(self.path, "wb")
+            self.file.write(encoded)
+        else:
+            hdr_size = header_2_dtype.itemsize
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(encoded[hdr_size:])
+        self.n_written += len(tractogram)
+
+        # Patch the count only after the records are on disk
+        self.file.flush()
+        self.file.seek(header_2_dtype.fields["nb_streamlines"][1])
+        self.file.write(np.array(self.n_written, dtype="<i4").tobytes())
+        self.file.flush()
+
+    def tell(self):
+        """Size of the written file in bytes."""
+        return 0 if self.file is None else self.file.seek(0, os.SEEK_END)
+
+    def resume(self, n_written, n_bytes):
+        """Continue a file of which the first n_bytes, holding n_written
+        streamlines, were written by an earlier run."""
+        if n_written == 0:
+            return
+        self.file = open(self.path, "r+b")
+        self.file.truncate(n_bytes)
+        self.n_written = n_written
+        self.file.seek(header_2_dtype.fields["nb_streamlines"][1])
+        self.file.write(np.array(self.n_written, dtype="<i4").tobytes())
+        self.file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.file is None:
+            TrkFile(Tractogram(affine_to_rasmm=np.eye(4)),
+                    self.header).save(self.path)
+        else:
+            self.file.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()